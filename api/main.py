@@ -5,13 +5,29 @@ import json
 import os
 import asyncio
 import logging
+from contextlib import asynccontextmanager
+import msgspec
+import numpy as np
 from services.traffic import DriveGraphEnv
 from services.geojson import GeoJSONService
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="City Simulation API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Parse the GeoJSON layers (and build the parcel index) before accepting
+    # traffic so the first client to toggle a layer doesn't wait on it
+    logger.info("Preloading GeoJSON data...")
+    await asyncio.to_thread(app.state.geojson.preload)
+    logger.info("Finished preloading GeoJSON data.")
+    yield
+
+
+app = FastAPI(title="City Simulation API", lifespan=lifespan)
+# Shared by every connection so parsed GeoJSON and the parcel index are built once
+app.state.geojson = GeoJSONService()
 
 # Add CORS middleware to allow frontend to access API endpoints
 app.add_middleware(
@@ -22,6 +38,73 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# All server -> client messages are MessagePack-encoded binary frames. Every
+# message keeps its "type" discriminator so the client dispatches the same way.
+encoder = msgspec.msgpack.Encoder()
+# Pre-encoded frames for the static GeoJSON layers, keyed by message type
+static_layer_frames = {}
+
+# Static layers that don't depend on bounds, by message type, with their loaders
+STATIC_LAYERS = {
+    "bart_lines": GeoJSONService.get_bart_lines,
+    "muni_stops": GeoJSONService.get_muni_stops,
+}
+
+# Number of parcel features per sf_parcels message
+PARCEL_CHUNK_SIZE = 500
+
+# Quiet period before an update_bounds burst is applied
+BOUNDS_DEBOUNCE_SECONDS = 0.15
+
+# Coordinates go over the wire as int32 micro-degrees (~10 cm precision)
+COORD_SCALE = 1_000_000
+
+
+async def send(websocket: WebSocket, payload: dict):
+    """Serialize a message with MessagePack and send it as a binary frame."""
+    await websocket.send_bytes(encoder.encode(payload))
+
+
+async def cancel_task(task: asyncio.Task):
+    """Cancel a background task (if any) and wait for it to finish."""
+    if task is None or task.done():
+        return
+    task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, Exception):
+        pass
+
+
+async def send_static_layer(websocket: WebSocket, layer_type: str, data: dict):
+    """
+    Send a BART/Muni layer. Their data never changes, so the encoded frame is built
+    once per process and reused for every client instead of re-encoding megabytes.
+    """
+    frame = static_layer_frames.get(layer_type)
+    if frame is None:
+        frame = static_layer_frames[layer_type] = encoder.encode({"type": layer_type, "data": data})
+    await websocket.send_bytes(frame)
+
+
+async def send_parcels(websocket: WebSocket, parcels_data: dict):
+    """
+    Send parcels in PARCEL_CHUNK_SIZE-feature messages so the client can render
+    the first ones while the rest are still arriving. Every chunk after the first
+    is flagged "append" to extend the features the client already has.
+    """
+    features = parcels_data["features"]
+    for start in range(0, max(len(features), 1), PARCEL_CHUNK_SIZE):
+        await send(websocket, {
+            "type": "sf_parcels",
+            "append": start > 0,
+            "data": {
+                "type": "FeatureCollection",
+                "features": features[start:start + PARCEL_CHUNK_SIZE]
+            }
+        })
+
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
@@ -30,11 +113,23 @@ def health():
 @app.websocket("/ws/traffic")
 async def websocket_endpoint_traffic(websocket: WebSocket):
     await websocket.accept()
-    await websocket.send_json({"type": "info", "message": "WebSocket connection established."})
+    await send(websocket, {"type": "info", "message": "WebSocket connection established."})
     env = None
     simulation_task = None
     agent_setter_task = None
-    geojson_service = GeoJSONService()
+    bounds_task = None
+    geojson_service = app.state.geojson
+    # Static layers (BART/Muni) already delivered on this connection; they don't
+    # depend on bounds so they are only re-sent after the client toggles them off
+    # (which it reports with set_layers)
+    sent_layers = set()
+    # The client's latest BART/Muni toggles, from whichever message carried them last.
+    # Debounced bounds updates read these rather than the toggles they arrived with
+    layer_toggles = {}
+    # Simulation updates go through a small queue drained by a dedicated sender, so
+    # a slow client never blocks the simulation or this loop's control messages
+    update_queue = asyncio.Queue(maxsize=4)
+    sender_task = asyncio.create_task(send_updates(websocket, update_queue))
     try:
         while True:
             data = await websocket.receive_json()
@@ -43,22 +138,22 @@ async def websocket_endpoint_traffic(websocket: WebSocket):
             if event_type == "start":
                 bounds = data.get("bounds")
                 if not bounds:
-                    await websocket.send_json({"type": "error", "message": "Missing bounds"})
+                    await send(websocket, {"type": "error", "message": "Missing bounds"})
                     continue
 
-                if simulation_task:
-                    simulation_task.cancel()
-                if agent_setter_task:
-                    agent_setter_task.cancel()
+                await cancel_task(simulation_task)
+                await cancel_task(agent_setter_task)
+                await cancel_task(bounds_task)
 
                 num_agents = data.get('num_agents', 1000)
                 show_traffic_lights = data.get('show_traffic_lights', True)
                 show_traffic_lanes = data.get('show_traffic_lanes', True)
-                show_bart_lines = data.get('show_bart_lines', False)
-                show_muni_stops = data.get('show_muni_stops', False)
                 show_sf_parcels = data.get('show_sf_parcels', False)
+                update_layer_toggles(layer_toggles, data)
                 
-                env = DriveGraphEnv(
+                # Loading the graph tiles is slow and blocking, keep it off the event loop
+                env = await asyncio.to_thread(
+                    DriveGraphEnv,
                     bounds=bounds, 
                     num_agents=num_agents,
                     show_traffic_lights=show_traffic_lights,
@@ -68,133 +163,265 @@ async def websocket_endpoint_traffic(websocket: WebSocket):
 
                 # Also send initial road network data
                 road_network_data = env.get_road_network_data()
-                await websocket.send_json({
+                await send(websocket, {
                     "type": "initial_road_network",
                     "lanes": road_network_data
                 })
 
                 # Send GeoJSON data based on toggles
-                if show_bart_lines:
-                    bart_data = geojson_service.get_bart_lines()
-                    if bart_data:
-                        await websocket.send_json({
-                            "type": "bart_lines",
-                            "data": bart_data
-                        })
-
-                if show_muni_stops:
-                    muni_data = geojson_service.get_muni_stops()
-                    if muni_data:
-                        await websocket.send_json({
-                            "type": "muni_stops",
-                            "data": muni_data
-                        })
+                sent_layers.clear()
+                await sync_static_layers(websocket, geojson_service, sent_layers, layer_toggles)
 
                 if show_sf_parcels:
-                    parcels_data = geojson_service.get_sf_parcels_by_bbox(bounds)
-                    await websocket.send_json({
-                        "type": "sf_parcels",
-                        "data": parcels_data
-                    })
+                    parcels_data = await asyncio.to_thread(geojson_service.get_sf_parcels_by_bbox, bounds)
+                    await send_parcels(websocket, parcels_data)
 
-                simulation_task = asyncio.create_task(run_simulation(websocket, env))
+                drain_queue(update_queue)
+                simulation_task = asyncio.create_task(run_simulation(websocket, env, update_queue))
 
             elif event_type == "update_bounds":
                 bounds = data.get("bounds")
                 if not bounds:
-                    await websocket.send_json({"type": "error", "message": "Missing bounds"})
+                    await send(websocket, {"type": "error", "message": "Missing bounds"})
                     continue
                 if env:
-                    show_traffic_lights = data.get('show_traffic_lights', True)
-                    show_traffic_lanes = data.get('show_traffic_lanes', True)
-                    show_bart_lines = data.get('show_bart_lines', False)
-                    show_muni_stops = data.get('show_muni_stops', False)
-                    show_sf_parcels = data.get('show_sf_parcels', False)
-                    
-                    env.update_bounds(bounds, show_traffic_lights, show_traffic_lanes)
-                    
-                    # Send updated road network data
-                    road_network_data = env.get_road_network_data()
-                    await websocket.send_json({
-                        "type": "road_network_update",
-                        "lanes": road_network_data
-                    })
-
-                    # Send updated GeoJSON data based on toggles
-                    if show_bart_lines:
-                        bart_data = geojson_service.get_bart_lines()
-                        if bart_data:
-                            await websocket.send_json({
-                                "type": "bart_lines",
-                                "data": bart_data
-                            })
-
-                    if show_muni_stops:
-                        muni_data = geojson_service.get_muni_stops()
-                        if muni_data:
-                            await websocket.send_json({
-                                "type": "muni_stops",
-                                "data": muni_data
-                            })
-
-                    if show_sf_parcels:
-                        parcels_data = geojson_service.get_sf_parcels_by_bbox(bounds)
-                        await websocket.send_json({
-                            "type": "sf_parcels",
-                            "data": parcels_data
-                        })
+                    update_layer_toggles(layer_toggles, data)
+                    # Panning fires update_bounds in bursts; only the last one in a
+                    # BOUNDS_DEBOUNCE_SECONDS window does the heavy reload
+                    await cancel_task(bounds_task)
+                    bounds_task = asyncio.create_task(
+                        apply_bounds_update(websocket, env, geojson_service, data, sent_layers, layer_toggles)
+                    )
                 else:
-                    await websocket.send_json({"type": "error", "message": "Simulation not started"})
+                    await send(websocket, {"type": "error", "message": "Simulation not started"})
+
+            elif event_type == "set_layers":
+                # Sent whenever the client flips a BART/Muni toggle, so a layer toggled off and
+                # back on between two update_bounds is sent again
+                update_layer_toggles(layer_toggles, data)
+                await sync_static_layers(websocket, geojson_service, sent_layers, layer_toggles)
 
             elif event_type == "set_num_agents":
                 if env:
                     num_agents = data.get('num_agents')
                     if num_agents is not None:
-                        if agent_setter_task and not agent_setter_task.done():
-                            agent_setter_task.cancel()
+                        await cancel_task(agent_setter_task)
                         
-                        await websocket.send_json({"type": "info", "message": f"Setting agent count to {num_agents} in the background..."})
+                        await send(websocket, {"type": "info", "message": f"Setting agent count to {num_agents} in the background..."})
                         agent_setter_task = asyncio.create_task(env.set_num_agents(num_agents))
                     else:
-                        await websocket.send_json({"type": "error", "message": "Missing num_agents"})
+                        await send(websocket, {"type": "error", "message": "Missing num_agents"})
                 else:
-                    await websocket.send_json({"type": "error", "message": "Simulation not started"})
+                    await send(websocket, {"type": "error", "message": "Simulation not started"})
 
             elif event_type == "stop":
-                if simulation_task:
-                    simulation_task.cancel()
-                    simulation_task = None
-                if agent_setter_task:
-                    agent_setter_task.cancel()
-                    agent_setter_task = None
-                await websocket.send_json({"type": "info", "message": "Simulation stopped"})
+                await cancel_task(simulation_task)
+                simulation_task = None
+                await cancel_task(agent_setter_task)
+                agent_setter_task = None
+                drain_queue(update_queue)
+                await send(websocket, {"type": "info", "message": "Simulation stopped"})
 
     except WebSocketDisconnect:
         logger.info("Client disconnected from websocket")
-        if simulation_task:
-            simulation_task.cancel()
-        if agent_setter_task:
-            agent_setter_task.cancel()
     except Exception as e:
         logger.error(f"Error in websocket: {e}", exc_info=True)
         # The connection might be closed already, so this might fail
         try:
-            await websocket.send_json({"type": "error", "message": str(e)})
+            await send(websocket, {"type": "error", "message": str(e)})
         except Exception as send_error:
             logger.error(f"Could not send error to client: {send_error}")
+    finally:
+        # Wait for the background tasks to actually finish so their frames (and the
+        # env they hold on to) are released now rather than whenever the loop gets to it
+        await cancel_task(simulation_task)
+        await cancel_task(agent_setter_task)
+        await cancel_task(bounds_task)
+        await cancel_task(sender_task)
+        env = None
+
+
+def quantize_coords(coords) -> list:
+    """Scale [lat, lng] coordinates (or nested lists of them) to int micro-degrees."""
+    return np.round(np.asarray(coords, dtype=np.float64) * COORD_SCALE).astype(np.int32).tolist()
+
+
+def snapshot_agents(env: DriveGraphEnv, prev: dict) -> dict:
+    """
+    Quantized state of every agent: agent id -> (position, path source, path).
+
+    Positions are quantized in one vectorized op. A path only changes when the agent
+    respawns, which replaces its path_positions array (the path source), so paths
+    are only quantized for agents whose source differs from the one in prev.
+    """
+    agents, positions = env.get_agent_positions()
+    positions = np.round(positions * COORD_SCALE).astype(np.int32).tolist()
+    snapshot = {}
+    for agent, position in zip(agents, positions):
+        source = agent.path_positions
+        old = prev.get(agent.agent_id)
+        if old is not None and old[1] is source:
+            path = old[2]
+        else:
+            path = quantize_coords(source) if source is not None and len(source) else []
+        snapshot[agent.agent_id] = (position, source, path)
+    return snapshot
+
+
+def agent_messages(snapshot: dict) -> dict:
+    """Every agent in a snapshot_agents() snapshot, whole, as sent in a full update."""
+    return {
+        agent_id: {"id": agent_id, "position": position, "path": path}
+        for agent_id, (position, _, path) in snapshot.items()
+    }
+
 
+def pack_emissions(emissions: list) -> dict:
+    """
+    Pack get_emissions_data() into binary columns: positions as little-endian int32
+    micro-degree [lng, lat] pairs and weights as little-endian float16.
+    """
+    positions = np.array([e["position"] for e in emissions], dtype=np.float64).reshape(-1, 2)
+    weights = np.array([e["weight"] for e in emissions], dtype="<f2")
+    return {
+        "positions": np.round(positions * COORD_SCALE).astype("<i4").tobytes(),
+        "weights": weights.tobytes(),
+    }
 
-async def run_simulation(websocket: WebSocket, env: DriveGraphEnv):
-    """Coroutine to run the simulation and send updates."""
+
+def diff_agent_states(prev: dict, current: dict):
+    """
+    Compare two snapshot_agents() snapshots.
+
+    Returns (changed, removed): changed maps agent id to the fields that differ
+    from the previous snapshot (always including "id"; new agents are sent whole),
+    removed lists the ids that no longer exist.
+    """
+    changed = {}
+    for agent_id, state in current.items():
+        position, source, path = state
+        old = prev.get(agent_id)
+        if old is None:
+            changed[agent_id] = {"id": agent_id, "position": position, "path": path}
+            continue
+        delta = {}
+        if position != old[0]:
+            delta["position"] = position
+        # Paths are only ever replaced, never edited in place, so identity is enough
+        if source is not old[1]:
+            delta["path"] = path
+        if delta:
+            delta["id"] = agent_id
+            changed[agent_id] = delta
+    removed = [agent_id for agent_id in prev if agent_id not in current]
+    return changed, removed
+
+
+async def apply_bounds_update(websocket: WebSocket, env: DriveGraphEnv, geojson_service: GeoJSONService,
+                              data: dict, sent_layers: set, layer_toggles: dict):
+    """Debounced handler for update_bounds: reload the env for the new bounds and resend the layers."""
+    await asyncio.sleep(BOUNDS_DEBOUNCE_SECONDS)
+    try:
+        bounds = data["bounds"]
+        show_traffic_lights = data.get('show_traffic_lights', True)
+        show_traffic_lanes = data.get('show_traffic_lanes', True)
+        show_sf_parcels = data.get('show_sf_parcels', False)
+    
+        await env.update_bounds(bounds, show_traffic_lights, show_traffic_lanes)
+    
+        # Send updated road network data
+        road_network_data = env.get_road_network_data()
+        await send(websocket, {
+            "type": "road_network_update",
+            "lanes": road_network_data
+        })
+
+        # Send updated GeoJSON data based on the toggles as they are now, not as they were
+        # when this update arrived
+        await sync_static_layers(websocket, geojson_service, sent_layers, layer_toggles)
+
+        if show_sf_parcels:
+            parcels_data = await asyncio.to_thread(geojson_service.get_sf_parcels_by_bbox, bounds)
+            await send_parcels(websocket, parcels_data)
+    except Exception as e:
+        logger.error(f"Error updating bounds: {e}", exc_info=True)
+        try:
+            await send(websocket, {"type": "error", "message": f"Failed to update bounds: {e}"})
+        except Exception as send_error:
+            logger.error(f"Could not send bounds error to client: {send_error}")
+
+
+def update_layer_toggles(layer_toggles: dict, data: dict):
+    """Record the BART/Muni toggles carried by a client message."""
+    for layer in STATIC_LAYERS:
+        layer_toggles[layer] = data.get(f"show_{layer}", False)
+
+
+async def sync_static_layers(websocket: WebSocket, geojson_service: GeoJSONService, sent_layers: set,
+                             layer_toggles: dict):
+    """
+    Bring the client's BART/Muni layers in line with its latest toggles. They don't
+    change with bounds, so a layer is only sent if the client doesn't have it yet;
+    one that is toggled off is forgotten, since the client drops its copy.
+    """
+    for layer, load in STATIC_LAYERS.items():
+        if not layer_toggles.get(layer):
+            sent_layers.discard(layer)
+        elif layer not in sent_layers:
+            layer_data = await asyncio.to_thread(load, geojson_service)
+            # Recheck after the await: the client may have toggled the layer off (or another
+            # sync sent it) meanwhile. Marking it before the send lets a toggle-off that
+            # arrives during the send still clear it
+            if layer_data and layer_toggles.get(layer) and layer not in sent_layers:
+                sent_layers.add(layer)
+                await send_static_layer(websocket, layer, layer_data)
+
+
+def drain_queue(queue: asyncio.Queue):
+    """Discard everything currently waiting in a queue."""
+    while not queue.empty():
+        queue.get_nowait()
+
+
+async def send_updates(websocket: WebSocket, update_queue: asyncio.Queue):
+    """Sender task: writes queued simulation updates to the websocket in order."""
+    try:
+        while True:
+            payload = await update_queue.get()
+            await send(websocket, payload)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.error(f"Could not send update to client: {e}")
+
+
+async def run_simulation(websocket: WebSocket, env: DriveGraphEnv, update_queue: asyncio.Queue):
+    """Coroutine to run the simulation and queue updates for the sender task."""
+    # Agent state the client already has. The first update carries every agent
+    # ("full"), later ones only new/moved agents plus the ids that were removed.
+    prev_agent_states = {}
     try:
         while True:
             await env.step()
-            agent_states = env.get_agent_states()
-            emissions_data = env.get_emissions_data()
+            agent_states = snapshot_agents(env, prev_agent_states)
+            emissions_data = pack_emissions(env.get_emissions_data())
             traffic_lights = env.get_traffic_light_states()
-            await websocket.send_json({
+
+            # If the client can't keep up, the queued updates are stale: drop them and
+            # resync with a full snapshot rather than blocking the simulation on send
+            full = not prev_agent_states or update_queue.full()
+            if full:
+                drain_queue(update_queue)
+                changed_agents, removed_agents = agent_messages(agent_states), []
+            else:
+                changed_agents, removed_agents = diff_agent_states(prev_agent_states, agent_states)
+            prev_agent_states = agent_states
+
+            update_queue.put_nowait({
                 "type": "update",
-                "agents": agent_states,
+                "full": full,
+                "agents": changed_agents,
+                "removed": removed_agents,
                 "emissions": emissions_data,
                 "traffic_lights": traffic_lights
             })
@@ -204,11 +431,13 @@ async def run_simulation(websocket: WebSocket, env: DriveGraphEnv):
     except Exception as e:
         logger.error(f"Error during simulation: {e}", exc_info=True)
         try:
-            await websocket.send_json({"type": "error", "message": f"Simulation failed: {e}"})
+            await send(websocket, {"type": "error", "message": f"Simulation failed: {e}"})
         except Exception as send_error:
             logger.error(f"Could not send simulation error to client: {send_error}")
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # permessage-deflate is negotiated with clients that support it; GeoJSON layers
+    # and update frames compress well, so this is a large bandwidth saving
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_per_message_deflate=True)
@@ -1,35 +1,70 @@
-import json
 import os
+import threading
+import numpy as np
+import orjson
+import pyogrio
 from typing import Dict, List, Any, Optional
 from pathlib import Path
+from shapely.geometry import box, shape
+from shapely.errors import ShapelyError
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
 
 
 class GeoJSONService:
     """Service for handling GeoJSON data sources"""
     
-    def __init__(self):
-        self.data_dir = Path(__file__).parent.parent / "data"
+    def __init__(self, data_dir: Optional[Path] = None):
+        self.data_dir = data_dir or Path(__file__).parent.parent / "data"
+        # Paths are resolved once here; each file is opened at most once per process
+        self.bart_file = self.data_dir / "bart_lines.geojson"
+        self.muni_file = self.data_dir / "muni_stops.geojson"
+        self.parcels_file = self.data_dir / "sf_parcel_data.geojson"
+        self.parcels_fgb_file = self.data_dir / "sf_parcel_data.fgb"
+        self._use_parcels_fgb = self.parcels_fgb_file.exists()
         self._bart_data = None
+        self._bart_loaded = False
         self._muni_data = None
+        self._muni_loaded = False
+        self._parcels = None
+        self._parcel_index = None
+        # The service is shared across connections and loaded from worker threads
+        self._lock = threading.Lock()
         
+    def preload(self):
+        """Load every data source up front so requests only hit the in-memory caches"""
+        self.get_bart_lines()
+        self.get_muni_stops()
+        # The FlatGeobuf path reads straight from disk, so only the GeoJSON fallback needs loading
+        if not self._use_parcels_fgb:
+            self._load_parcels()
+    
     def get_bart_lines(self) -> Dict[str, Any]:
         """Get BART lines GeoJSON data"""
-        if self._bart_data is None:
-            bart_file = self.data_dir / "bart_lines.geojson"
-            if bart_file.exists():
-                with open(bart_file, 'r') as f:
-                    self._bart_data = json.load(f)
+        if not self._bart_loaded:
+            with self._lock:
+                if not self._bart_loaded:
+                    self._bart_data = self._read_geojson(self.bart_file)
+                    self._bart_loaded = True
         return self._bart_data
     
     def get_muni_stops(self) -> Dict[str, Any]:
         """Get Muni stops GeoJSON data"""
-        if self._muni_data is None:
-            muni_file = self.data_dir / "muni_stops.geojson"
-            if muni_file.exists():
-                with open(muni_file, 'r') as f:
-                    self._muni_data = json.load(f)
+        if not self._muni_loaded:
+            with self._lock:
+                if not self._muni_loaded:
+                    self._muni_data = self._read_geojson(self.muni_file)
+                    self._muni_loaded = True
         return self._muni_data
     
+    def _read_geojson(self, path: Path) -> Optional[Dict[str, Any]]:
+        """Parse a GeoJSON file, or return None if it doesn't exist"""
+        try:
+            with open(path, 'rb') as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            return None
+    
     def get_sf_parcels_by_bbox(self, bounds: Dict[str, float]) -> Dict[str, Any]:
         """
         Get SF parcel data filtered by bounding box
@@ -37,59 +72,68 @@ class GeoJSONService:
         Args:
             bounds: Dictionary with minLng, maxLng, minLat, maxLat keys
         """
-        parcels_file = self.data_dir / "sf_parcel_data.geojson"
-        if not parcels_file.exists():
-            return {"type": "FeatureCollection", "features": []}
-        
         min_lng = bounds['minLng']
         max_lng = bounds['maxLng']
         min_lat = bounds['minLat']
         max_lat = bounds['maxLat']
         
-        filtered_features = []
+        # Prefer the FlatGeobuf copy when present: its packed spatial index lets
+        # GDAL read only the features in the query box without parsing the rest
+        if self._use_parcels_fgb:
+            gdf = pyogrio.read_dataframe(self.parcels_fgb_file, mask=box(min_lng, min_lat, max_lng, max_lat))
+            if gdf.empty:
+                return {"type": "FeatureCollection", "features": []}
+            return orjson.loads(gdf.to_json())
+        
+        parcels = self._load_parcels()
+        if not parcels:
+            return {"type": "FeatureCollection", "features": []}
         
-        # Stream through the large file to avoid loading it all into memory
-        with open(parcels_file, 'r') as f:
-            data = json.load(f)
-            
-            for feature in data.get('features', []):
-                if self._feature_intersects_bbox(feature, min_lng, max_lng, min_lat, max_lat):
-                    filtered_features.append(feature)
+        # One vectorized STRtree call does both the envelope search and the exact
+        # intersection test (against a prepared query box) inside GEOS. Sorting keeps
+        # the original feature order so responses are stable between pans.
+        hits = np.sort(self._parcel_index.query(box(min_lng, min_lat, max_lng, max_lat), predicate='intersects'))
+        filtered_features = [parcels[i] for i in hits]
         
         return {
             "type": "FeatureCollection",
             "features": filtered_features
         }
     
-    def _feature_intersects_bbox(self, feature: Dict[str, Any], min_lng: float, max_lng: float, 
-                                min_lat: float, max_lat: float) -> bool:
-        """Check if a feature intersects with the given bounding box"""
-        geometry = feature.get('geometry', {})
-        geom_type = geometry.get('type')
-        coordinates = geometry.get('coordinates', [])
-        
-        if geom_type == 'Point':
-            lng, lat = coordinates
-            return min_lng <= lng <= max_lng and min_lat <= lat <= max_lat
-            
-        elif geom_type == 'Polygon':
-            # Check if any point in the polygon is within the bbox
-            for ring in coordinates:
-                for point in ring:
-                    lng, lat = point
-                    if min_lng <= lng <= max_lng and min_lat <= lat <= max_lat:
-                        return True
-            return False
-            
-        elif geom_type == 'MultiPolygon':
-            # Check if any point in any polygon is within the bbox
-            for polygon in coordinates:
-                for ring in polygon:
-                    for point in ring:
-                        lng, lat = point
-                        if min_lng <= lng <= max_lng and min_lat <= lat <= max_lat:
-                            return True
-            return False
-            
-        # For other geometry types, include by default
-        return True
\ No newline at end of file
+    def _load_parcels(self) -> List[Dict[str, Any]]:
+        """Parse the parcels file once and build an STRtree over the feature geometries"""
+        if self._parcels is None:
+            with self._lock:
+                if self._parcels is None:
+                    data = self._read_geojson(self.parcels_file) or {}
+                    features = data.get('features', [])
+                    
+                    # Features without a usable geometry stay as None, which STRtree skips
+                    geoms = [self._feature_geometry(feature) for feature in features]
+                    self._parcel_index = STRtree(geoms)
+                    self._parcels = features
+        return self._parcels
+    
+    def _feature_geometry(self, feature: Dict[str, Any]) -> Optional[BaseGeometry]:
+        """Convert a GeoJSON feature's geometry to a Shapely geometry, or None if it is missing or invalid"""
+        geometry = feature.get('geometry')
+        if not geometry or not geometry.get('coordinates'):
+            return None
+        try:
+            return shape(geometry)
+        except (ShapelyError, ValueError, TypeError):
+            return None
+
+
+def convert_parcels_to_flatgeobuf(data_dir: Optional[Path] = None) -> Path:
+    """One-time conversion of sf_parcel_data.geojson to a spatially indexed FlatGeobuf file"""
+    data_dir = data_dir or Path(__file__).parent.parent / "data"
+    source = data_dir / "sf_parcel_data.geojson"
+    target = data_dir / "sf_parcel_data.fgb"
+    gdf = pyogrio.read_dataframe(source)
+    pyogrio.write_dataframe(gdf, target, driver="FlatGeobuf", SPATIAL_INDEX="YES")
+    return target
+
+
+if __name__ == "__main__":
+    print(f"Wrote {convert_parcels_to_flatgeobuf()}")
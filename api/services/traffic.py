@@ -3,55 +3,338 @@ import torch
 from gymnasium.spaces import Box, Dict as SpaceDict, Discrete
 from typing import Dict, List, Tuple, Any, Optional, Union, Set
 import logging
-from dataclasses import dataclass
 import math
 import osmnx as ox
 import geopandas as gpd
 from pyproj import CRS
+from shapely import affinity
 from shapely.geometry import Point, Polygon, LineString
 import networkx as nx
-import json
-from networkx.readwrite import json_graph
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+import orjson
+import pickle
 import sys
 import os
 import asyncio
+import threading
+import time
 import tempfile
 import shutil
 from osmnx._errors import InsufficientResponseError
 import hashlib
+from functools import cached_property, lru_cache
+import shapely
+from numba import njit, prange
 
 logger = logging.getLogger(__name__)
 
-# Custom JSON encoder to handle numpy types
-class NpEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        if isinstance(obj, np.floating):
-            return float(obj)
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        return super(NpEncoder, self).default(obj)
-
 # Constants for the urban environment
 MAX_AGENTS = 100000
 MAX_SPEED = 0.0005
+MICRODEGREES = 1_000_000
+# Memoized single-source Dijkstra results for respawn, capped by count and by memory
+MAX_CACHED_SSSP = 256
+SSSP_CACHE_MEMORY_BYTES = 32 * 1024 * 1024
+# Live searches between viewport nodes stop at this multiple of the viewport diagonal
+LIVE_SEARCH_RADIUS_FACTOR = 2.0
+# Hub routing: predecessor rows from and to a sample of nodes, capped by count and by memory
+MAX_ROUTING_HUBS = 256
+HUB_ROUTES_MEMORY_BYTES = 32 * 1024 * 1024
+
+# Traffic light states as stored in DriveGraphEnv._tl_state
+TL_RED = 0
+TL_GREEN = 1
+
+# What happened to an agent in the step kernel
+AGENT_MOVED = 0
+AGENT_ARRIVED = 1
+AGENT_STOPPED = 2
+
+# Tile keys holding node GeoDataFrames, which are cached as plain columns plus point coordinates
+NODE_TABLE_KEYS = ('graph_gdf_nodes_proj', 'graph_gdf_nodes_unproj')
+
+
+def _compact_nodes(nodes: gpd.GeoDataFrame) -> Dict[str, Any]:
+    """Splits a point GeoDataFrame into its attribute columns and x/y arrays for caching."""
+    coords = shapely.get_coordinates(nodes.geometry.values)
+    return {
+        'columns': gpd.pd.DataFrame(nodes.drop(columns=nodes.geometry.name)),
+        'x': coords[:, 0],
+        'y': coords[:, 1],
+        'crs': nodes.crs,
+    }
+
+
+def _expand_nodes(compact: Dict[str, Any]) -> gpd.GeoDataFrame:
+    """Rebuilds a node GeoDataFrame from _compact_nodes output with one vectorized point constructor."""
+    geometry = gpd.points_from_xy(compact['x'], compact['y'])
+    return gpd.GeoDataFrame(compact['columns'], geometry=geometry, crs=compact['crs'])
+
+
+@lru_cache(maxsize=4096)
+def _tile_cache_filename(min_lat: float, max_lat: float, min_lng: float, max_lng: float) -> str:
+    """Cache filename for a snapped tile; memoized since the same few tiles are looked up on every pan."""
+    # Use a hash of the bounds to create a consistent filename.
+    # The user is complaining about too many downloads, and this is because the bounds are floating point numbers.
+    # Hashing the string representation of the bounds will ensure that the same tile is referenced for the same bounds.
+    bounds_str = f"{min_lat:.4f},{max_lat:.4f},{min_lng:.4f},{max_lng:.4f}"
+    
+    # Use a simple and fast hash.
+    return f"{hashlib.sha1(bounds_str.encode()).hexdigest()}.pkl"
+
+
+def _memoized_predecessors(routing_csr: csr_matrix):
+    """Returns an LRU-cached predecessors(source_row, limit) over routing_csr, by edge length.
+
+    Each result is the int32 predecessor row of a single-source Dijkstra from
+    source_row (negative where unreachable, or further than limit metres), so any
+    goal's path can be traced from it without searching again.
+    """
+    num_nodes = routing_csr.shape[0]
+    @lru_cache(maxsize=min(MAX_CACHED_SSSP, max(1, SSSP_CACHE_MEMORY_BYTES // (4 * max(num_nodes, 1)))))
+    def predecessors(source_row: int, limit: float = np.inf) -> np.ndarray:
+        _, pred = dijkstra(routing_csr, indices=source_row, return_predecessors=True, limit=limit)
+        return pred.astype(np.int32)
+    return predecessors
+
+
+def _trace_predecessors(pred: np.ndarray, row: int, stop_row: int) -> Optional[List[int]]:
+    """Rows visited following pred from row until stop_row, or None if the chain breaks first."""
+    rows = [row]
+    while row != stop_row:
+        row = int(pred[row])
+        if row < 0:
+            return None
+        rows.append(row)
+    return rows
+
+
+def _sorted_contains(sorted_ids: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Vectorized membership test of ids against a sorted unique array, via binary search."""
+    if not len(sorted_ids):
+        return np.zeros(len(ids), dtype=bool)
+    pos = np.searchsorted(sorted_ids, ids)
+    pos[pos == len(sorted_ids)] = 0
+    return sorted_ids[pos] == ids
+
+
+@njit(cache=True)
+def _filter_bounds(node_xy, valid_mask, min_lat, max_lat, min_lng, max_lng, out_idx):
+    """Writes the row indices of valid nodes inside the box into out_idx and returns their count."""
+    k = 0
+    for i in range(node_xy.shape[0]):
+        lat = node_xy[i, 0]
+        lng = node_xy[i, 1]
+        if valid_mask[i] and lat >= min_lat and lat <= max_lat and lng >= min_lng and lng <= max_lng:
+            out_idx[k] = i
+            k += 1
+    return k
+
+
+@njit(cache=True)
+def _tick_traffic_lights(states, timers, cycles, node_rows, node_red, wait_head, wait_next, stopped):
+    """Advances every light's timer by one step, flipping red/green once its cycle time is reached.
+
+    cycles is (L, 2): each light's red and green duration, indexed by state. Flips
+    are mirrored into node_red, the per-node red flag at each light's node row.
+    A light turning green releases the agents waiting at its node: wait_head and
+    wait_next chain them per node row, and their stopped flags are cleared.
+    """
+    for i in range(states.shape[0]):
+        timers[i] += 1
+        if timers[i] >= cycles[i, states[i]]:
+            timers[i] = 0
+            states[i] ^= 1
+            row = node_rows[i]
+            node_red[row] = states[i] == TL_RED
+            if states[i] == TL_GREEN:
+                agent = wait_head[row]
+                while agent >= 0:
+                    stopped[agent] = False
+                    agent = wait_next[agent]
+                wait_head[row] = -1
+
+
+@njit(cache=True)
+def _path_edge_rows(indptr, indices, path_rows):
+    """Position in the CSR data of each edge along a path of node rows, or -1 where there's no such edge."""
+    out = np.empty(path_rows.shape[0] - 1, dtype=np.int64)
+    for i in range(path_rows.shape[0] - 1):
+        lo = indptr[path_rows[i]]
+        hi = indptr[path_rows[i] + 1]
+        j = lo + np.searchsorted(indices[lo:hi], path_rows[i + 1])
+        out[i] = j if j < hi and indices[j] == path_rows[i + 1] else -1
+    return out
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _advance(routed, stopped, positions, velocities, node_xy, next_rows, speeds, edge_dirs, remaining, node_red, events):
+    """Moves every routed agent one step towards its next node, stopping at red lights.
+
+    edge_dirs and remaining are each agent's unit vector towards its next node and
+    the distance left to it, set once per edge, so a step needs no norm. Agents
+    within a step of their next node snap onto it (AGENT_ARRIVED in events).
+    Agents that reach a red light are flagged in stopped (AGENT_STOPPED) and
+    skipped from then on, until the light turning green clears the flag. Each
+    iteration only writes its own row, so agents are spread across threads.
+    """
+    for i in prange(routed.shape[0]):
+        events[i] = AGENT_MOVED
+        if not routed[i] or stopped[i]:
+            continue
+        speed = speeds[i]
+        red = node_red[next_rows[i]]
+        if red:
+            velocities[i, 0] = 0.0
+            velocities[i, 1] = 0.0
+        else:
+            velocities[i, 0] = edge_dirs[i, 0] * speed
+            velocities[i, 1] = edge_dirs[i, 1] * speed
+
+        if remaining[i] < speed:
+            positions[i, 0] = node_xy[next_rows[i], 0]
+            positions[i, 1] = node_xy[next_rows[i], 1]
+            events[i] = AGENT_ARRIVED
+        elif red:
+            # Nothing changes for this agent until the light turns green
+            stopped[i] = True
+            events[i] = AGENT_STOPPED
+        else:
+            positions[i, 0] += velocities[i, 0]
+            positions[i, 1] += velocities[i, 1]
+            remaining[i] -= speed
+
+
+@njit(cache=True)
+def _link_waiting(stopped, next_rows, wait_head, wait_next):
+    """Rebuilds the per-node chains of stopped agents from scratch."""
+    wait_head[:] = -1
+    for i in range(stopped.shape[0]):
+        if stopped[i]:
+            wait_next[i] = wait_head[next_rows[i]]
+            wait_head[next_rows[i]] = i
+
+
+@njit(cache=True)
+def _measure_edges(slots, positions, node_xy, next_rows, edge_dirs, remaining):
+    """Sets the unit vector towards the next node and the distance left to it for the given slots."""
+    for j in range(slots.shape[0]):
+        i = slots[j]
+        dlat = node_xy[next_rows[i], 0] - positions[i, 0]
+        dlng = node_xy[next_rows[i], 1] - positions[i, 1]
+        distance = math.sqrt(dlat * dlat + dlng * dlng)
+        remaining[i] = distance
+        # A zero-length edge gets no direction; the agent is already at its end
+        edge_dirs[i, 0] = dlat / distance if distance > 0 else 0.0
+        edge_dirs[i, 1] = dlng / distance if distance > 0 else 0.0
+
+
+@njit(cache=True)
+def _collect_events(events, next_rows, wait_head, wait_next, arrived_out):
+    """Serial pass over the step kernel's events.
+
+    Newly stopped agents are chained onto their node's waiting list; the slots of
+    arrived agents are written into arrived_out and their count is returned.
+    """
+    k = 0
+    for i in range(events.shape[0]):
+        if events[i] == AGENT_ARRIVED:
+            arrived_out[k] = i
+            k += 1
+        elif events[i] == AGENT_STOPPED:
+            wait_next[i] = wait_head[next_rows[i]]
+            wait_head[next_rows[i]] = i
+    return k
+
+
+@njit(cache=True)
+def _gather_observations(active, positions, velocities, goals, out):
+    """Writes [position, velocity, goal] of each active slot, in slot order, into out's rows and returns their count."""
+    k = 0
+    for i in range(active.shape[0]):
+        if active[i]:
+            out[k, 0] = positions[i, 0]
+            out[k, 1] = positions[i, 1]
+            out[k, 2] = velocities[i, 0]
+            out[k, 3] = velocities[i, 1]
+            out[k, 4] = goals[i, 0]
+            out[k, 5] = goals[i, 1]
+            k += 1
+    return k
+
 
-@dataclass
 class AgentState:
-    """Represents the state of a single agent in the urban environment"""
-    agent_id: str
-    position: np.ndarray
-    velocity: np.ndarray
-    goal: np.ndarray
-    path: Optional[List[int]] = None
-    path_index: int = 0
-    path_positions: Optional[np.ndarray] = None
+    """Represents the state of a single agent in the urban environment.
+    
+    Position, velocity, goal and path index are not stored on the agent: they are
+    row `slot` of the environment's shared per-agent arrays, read and written
+    through the properties below.
+    """
+    __slots__ = ('agent_id', 'slot', '_positions', '_velocities', '_goals', '_path_indices',
+                 'path', 'path_rows', 'path_positions', 'path_speeds')
+    
+    def __init__(self,
+                 agent_id: str,
+                 slot: int,
+                 positions: np.ndarray,
+                 velocities: np.ndarray,
+                 goals: np.ndarray,
+                 path_indices: np.ndarray,
+                 path: Optional[np.ndarray] = None,
+                 path_index: int = 0,
+                 path_rows: Optional[np.ndarray] = None,
+                 path_positions: Optional[np.ndarray] = None,
+                 path_speeds: Optional[np.ndarray] = None):
+        self.agent_id = agent_id
+        self.slot = slot
+        self._positions = positions
+        self._velocities = velocities
+        self._goals = goals
+        self._path_indices = path_indices
+        self.path = path  # node ids
+        self.path_index = path_index
+        self.path_rows = path_rows  # the same nodes as rows of the env's node arrays
+        self.path_positions = path_positions
+        self.path_speeds = path_speeds  # speed limit of each edge along the path, in degrees per step
+    
+    @property
+    def position(self) -> np.ndarray:
+        return self._positions[self.slot]
+    
+    @position.setter
+    def position(self, value: np.ndarray):
+        self._positions[self.slot] = value
+    
+    @property
+    def velocity(self) -> np.ndarray:
+        return self._velocities[self.slot]
+    
+    @velocity.setter
+    def velocity(self, value: np.ndarray):
+        self._velocities[self.slot] = value
+    
+    @property
+    def goal(self) -> np.ndarray:
+        return self._goals[self.slot]
+    
+    @goal.setter
+    def goal(self, value: np.ndarray):
+        self._goals[self.slot] = value
+    
+    @property
+    def path_index(self) -> int:
+        return int(self._path_indices[self.slot])
+    
+    @path_index.setter
+    def path_index(self, value: int):
+        self._path_indices[self.slot] = value
     
     def to_tensor(self) -> torch.Tensor:
         """Convert agent state to tensor representation"""
         state = np.concatenate([self.position, self.velocity, self.goal])
-        return torch.tensor(state, dtype=torch.float32)
+        return torch.from_numpy(state.astype(np.float32))
 
 class DriveGraphEnv:
     """
@@ -97,12 +380,41 @@ class DriveGraphEnv:
         self.max_zoom = max_zoom
         os.makedirs(self.cache_dir, exist_ok=True)
         self.tile_graphs = {}
+        self._rng = np.random.default_rng()
 
-        self._load_and_merge_graph_tiles(self.bounds)
+        # Runs its own event loop, so construct the env off the event loop (e.g. via asyncio.to_thread)
+        asyncio.run(self._load_and_merge_graph_tiles_async(self.bounds))
         self._initialize_traffic_lights()
 
         self.agents = {}  
         self.active_agents = set()  
+        # Agent kinematics as structure-of-arrays; each AgentState views one row (its slot).
+        # Float64 because positions are in degrees and float32 can't resolve a single step
+        self._pos = np.zeros((max_agents, 2), dtype=np.float64)
+        self._vel = np.zeros((max_agents, 2), dtype=np.float64)
+        self._goal = np.zeros((max_agents, 2), dtype=np.float64)
+        self._path_index = np.zeros(max_agents, dtype=np.int32)
+        # The _node_xy row of the node each agent is driving towards, and the current edge's speed in degrees per step
+        self._next_row = np.zeros(max_agents, dtype=np.intp)
+        self._speed = np.zeros(max_agents, dtype=np.float64)
+        # Unit vector towards the next node and the distance left to it, refreshed once per edge
+        self._edge_dir = np.zeros((max_agents, 2), dtype=np.float64)
+        self._remaining = np.zeros(max_agents, dtype=np.float64)
+        self._active = np.zeros(max_agents, dtype=bool)
+        self._routed = np.zeros(max_agents, dtype=bool)  # active and has a path
+        self._spawning = np.zeros(max_agents, dtype=bool)  # active and its first respawn hasn't finished yet
+        self._stopped = np.zeros(max_agents, dtype=bool)  # waiting at a red light; the step kernel skips these
+        # Stopped agents chained per node row (see _initialize_traffic_lights for the heads). An agent that
+        # stops waiting other than by its light turning green breaks its chain, so the chains get rebuilt
+        self._wait_next = np.full(max_agents, -1, dtype=np.intp)
+        self._wait_dirty = False
+        self._slot_agents: List[Optional[AgentState]] = [None] * max_agents
+        # Reused every step, so stepping doesn't allocate per agent
+        self._events = np.zeros(max_agents, dtype=np.int8)
+        self._arrived_buf = np.empty(max_agents, dtype=np.intp)
+        self._obs_buf = np.empty((max_agents, 6), dtype=np.float32)
+        self._free_slots = []
+        self._next_slot = 0
         
         self.steps = 0
         
@@ -110,14 +422,10 @@ class DriveGraphEnv:
 
     def _get_cache_path(self, bounds_for_cache: Dict[str, float]) -> str:
         """Generates a file path for the cache file based on bounds."""
-        # Use a hash of the bounds to create a consistent filename.
-        # The user is complaining about too many downloads, and this is because the bounds are floating point numbers.
-        # Hashing the string representation of the bounds will ensure that the same tile is referenced for the same bounds.
-        bounds_str = f"{bounds_for_cache['minLat']:.4f},{bounds_for_cache['maxLat']:.4f},{bounds_for_cache['minLng']:.4f},{bounds_for_cache['maxLng']:.4f}"
-        
-        # Use a simple and fast hash.
-        filename = f"{hashlib.sha1(bounds_str.encode()).hexdigest()}.json"
-        
+        filename = _tile_cache_filename(
+            bounds_for_cache['minLat'], bounds_for_cache['maxLat'],
+            bounds_for_cache['minLng'], bounds_for_cache['maxLng'],
+        )
         return os.path.join(self.cache_dir, filename)
 
     def _get_required_tile_bounds(self, bounds: Dict[str, float]) -> List[Dict[str, float]]:
@@ -136,80 +444,48 @@ class DriveGraphEnv:
 
     def _load_and_merge_graph_tiles(self, bounds: Dict[str, float]):
         """Loads graph data for required tiles and merges them."""
-        print(f"--- _load_and_merge_graph_tiles ---")
-        print(f"Initial bounds: {bounds}")
+        logger.debug(f"Initial bounds: {bounds}")
         required_tiles = self._get_required_tile_bounds(bounds)
-        print(f"Required tiles: {required_tiles}")
+        logger.debug(f"Required tiles: {required_tiles}")
         
         logger.info(f"Loading {len(required_tiles)} tiles for bounds {bounds}")
 
-        graphs_to_merge_proj = []
         graphs_to_merge_unproj = []
-        all_nodes_proj = []
         all_nodes_unproj = []
+        # The projected graph and node table are only merged if something asks for them
+        self._merged_tiles = []
+        self.__dict__.pop('drive_graph_proj', None)
+        self.__dict__.pop('graph_gdf_nodes_proj', None)
         
-        self.node_positions = {}
+        all_node_ids = []
+        all_node_xy = []
         self.valid_vehicle_node_ids = []
         self.road_network_data = {}
         self.traffic_signals = set()
 
         for tile_bounds in required_tiles:
-            print(f"Processing tile_bounds: {tile_bounds}")
+            logger.debug(f"Processing tile_bounds: {tile_bounds}")
             tile_key = self._get_cache_path(tile_bounds)
             
-            if tile_key not in self.tile_graphs or self.tile_graphs.get(tile_key) is None:
-                print(f"Tile not in memory or load previously failed, loading: {tile_key}")
-                self.tile_graphs[tile_key] = self._load_tile_graph(tile_bounds)
+            if tile_key in self.tile_graphs:
+                logger.debug(f"Tile already in memory: {tile_key}")
+                tile_data = self.tile_graphs[tile_key]
             else:
-                print(f"Tile already in memory: {tile_key}")
-
-            tile_data = self.tile_graphs.get(tile_key)
+                logger.debug(f"Tile not in memory, loading: {tile_key}")
+                tile_data = self.tile_graphs[tile_key] = self._load_tile_graph(tile_bounds)
             
-            if tile_data and tile_data.get('drive_graph_proj'):
-                print(f"--- PREPARING TO MERGE TILE {tile_key} ---")
-                print(f"Projected graph attributes: {tile_data['drive_graph_proj'].graph}")
-                print(f"Unprojected graph attributes: {tile_data['drive_graph_unproj'].graph}")
-
-                print(f"Adding tile data to merge list for tile: {tile_bounds}")
-                graphs_to_merge_proj.append(tile_data['drive_graph_proj'])
-                all_nodes_proj.append(tile_data['graph_gdf_nodes_proj'])
+            if tile_data and tile_data.get('drive_graph_unproj'):
+                self._merged_tiles.append(tile_data)
                 graphs_to_merge_unproj.append(tile_data['drive_graph_unproj'])
                 all_nodes_unproj.append(tile_data['graph_gdf_nodes_unproj'])
-                self.node_positions.update(tile_data['node_positions'])
+                all_node_ids.append(tile_data['node_ids'])
+                all_node_xy.append(tile_data['node_xy'])
                 self.valid_vehicle_node_ids.extend(tile_data['valid_vehicle_node_ids'])
             else:
-                print(f"No valid graph data to merge for tile: {tile_bounds}")
-
-        print("Starting merge of projected graphs...")
-        if graphs_to_merge_proj:
-            self.drive_graph_proj = nx.compose_all(graphs_to_merge_proj)
-            if self.drive_graph_proj.nodes:
-                print(f"--- MERGED PROJECTED GRAPH ---")
-                # Find a graph with CRS to set it on the merged graph
-                merged_crs = None
-                for g in graphs_to_merge_proj:
-                    if 'crs' in g.graph:
-                        merged_crs = g.graph['crs']
-                        break
-                
-                if merged_crs:
-                    self.drive_graph_proj.graph['crs'] = merged_crs
-                else:
-                    logger.warning("No CRS found in any of the projected graphs to be merged.")
-                
-                print(f"Attributes after CRS copy: {self.drive_graph_proj.graph}")
-            if all_nodes_proj:
-                self.graph_gdf_nodes_proj = gpd.pd.concat(all_nodes_proj, ignore_index=True).drop_duplicates(subset='osmid')
-                self.graph_gdf_nodes_proj = self.graph_gdf_nodes_proj.set_index('osmid', drop=False)
-                self.graph_gdf_nodes_proj = self.graph_gdf_nodes_proj[~self.graph_gdf_nodes_proj.index.duplicated(keep='first')]
-        else:
-            self.drive_graph_proj = nx.MultiDiGraph()
-            self.graph_gdf_nodes_proj = gpd.GeoDataFrame()
-        print("Finished merging projected graphs.")
+                logger.debug(f"No valid graph data to merge for tile: {tile_bounds}")
 
-        print("Starting merge of unprojected graphs...")
         if graphs_to_merge_unproj:
-            self.drive_graph_unproj = nx.compose_all(graphs_to_merge_unproj)
+            self.drive_graph_unproj = self._merge_graphs(graphs_to_merge_unproj)
             if self.drive_graph_unproj.nodes:
                 # Find a graph with CRS to set it on the merged graph
                 merged_crs = None
@@ -224,223 +500,225 @@ class DriveGraphEnv:
                     logger.warning("No CRS found in any of the unprojected graphs to be merged.")
                     self.drive_graph_unproj.graph['crs'] = "epsg:4326" # Default fallback
                 
-                print(f"Attributes after CRS copy: {self.drive_graph_unproj.graph}")
             else:
                 self.drive_graph_unproj.graph['crs'] = "epsg:4326"
             if all_nodes_unproj:
-                self.graph_gdf_nodes_unproj = gpd.pd.concat(all_nodes_unproj, ignore_index=True).drop_duplicates(subset='osmid')
-                self.graph_gdf_nodes_unproj = self.graph_gdf_nodes_unproj.set_index('osmid', drop=False)
-                self.graph_gdf_nodes_unproj = self.graph_gdf_nodes_unproj[~self.graph_gdf_nodes_unproj.index.duplicated(keep='first')]
+                self.graph_gdf_nodes_unproj = self._merge_node_tables(all_nodes_unproj)
         else:
             self.drive_graph_unproj = nx.MultiDiGraph(crs="epsg:4326")
             self.graph_gdf_nodes_unproj = gpd.GeoDataFrame()
-        print("Finished merging unprojected graphs.")
             
-        self.valid_vehicle_node_ids = list(set(self.valid_vehicle_node_ids))
-        print(f"Total unique valid vehicle nodes: {len(self.valid_vehicle_node_ids)}")
+        # Sorted and unique, so membership tests can use searchsorted/isin(assume_unique=True)
+        self.valid_vehicle_node_ids = np.unique(np.asarray(self.valid_vehicle_node_ids, dtype=np.int64))
+        logger.debug(f"Total unique valid vehicle nodes: {len(self.valid_vehicle_node_ids)}")
+        self._build_node_arrays(all_node_ids, all_node_xy)
+        self._build_routing_graph()
+        # A fresh cache per merge, so routes never outlive the graph they were found on
+        self._predecessors = _memoized_predecessors(self._routing_csr)
+        self._start_hub_routes()
+
+        # Edge geometries only change when tiles are reloaded, so build them and their index once here
+        if self.drive_graph_unproj.number_of_edges():
+            self._edges_gdf_unproj = ox.graph_to_gdfs(self.drive_graph_unproj, nodes=False)
+        else:
+            self._edges_gdf_unproj = gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+        self._edges_sindex = self._edges_gdf_unproj.sindex
 
         if self.show_traffic_lights:
             self._load_traffic_signals_for_bbox()
 
-        logger.info(f"Finished merging tiles. Total nodes: {len(self.drive_graph_proj.nodes()) if self.drive_graph_proj else 0}")
-        print(f"--- Finished _load_and_merge_graph_tiles ---")
+        logger.info(f"Finished merging tiles. Total nodes: {self.drive_graph_unproj.number_of_nodes()}")
+
+    @cached_property
+    def drive_graph_proj(self) -> nx.MultiDiGraph:
+        """Projected drive graph, merged from the loaded tiles on first access."""
+        graphs_to_merge_proj = [tile_data['drive_graph_proj'] for tile_data in self._merged_tiles]
+        if not graphs_to_merge_proj:
+            return nx.MultiDiGraph()
+        drive_graph_proj = self._merge_graphs(graphs_to_merge_proj)
+        if drive_graph_proj.nodes:
+            # Find a graph with CRS to set it on the merged graph
+            merged_crs = None
+            for g in graphs_to_merge_proj:
+                if 'crs' in g.graph:
+                    merged_crs = g.graph['crs']
+                    break
+            
+            if merged_crs:
+                drive_graph_proj.graph['crs'] = merged_crs
+            else:
+                logger.warning("No CRS found in any of the projected graphs to be merged.")
+        return drive_graph_proj
+
+    @cached_property
+    def graph_gdf_nodes_proj(self) -> gpd.GeoDataFrame:
+        """Projected node table, merged from the loaded tiles on first access."""
+        if not self._merged_tiles:
+            return gpd.GeoDataFrame()
+        return self._merge_node_tables([tile_data['graph_gdf_nodes_proj'] for tile_data in self._merged_tiles])
     
+    async def _load_and_merge_graph_tiles_async(self, bounds: Dict[str, float]):
+        """Fetches tiles that aren't in memory (or previously failed) concurrently, then merges them."""
+        required_tiles = self._get_required_tile_bounds(bounds)
+        tile_keys = [self._get_cache_path(tile_bounds) for tile_bounds in required_tiles]
+        missing = [(tile_key, tile_bounds) for tile_key, tile_bounds in zip(tile_keys, required_tiles)
+                   if self.tile_graphs.get(tile_key) is None]
+        if missing:
+            # OSM requests overlap and projection runs on worker threads; results are stored back here
+            results = await asyncio.gather(*[asyncio.to_thread(self._load_tile_graph, tile_bounds) for _, tile_bounds in missing])
+            for (tile_key, _), tile_data in zip(missing, results):
+                self.tile_graphs[tile_key] = tile_data
+        # The merge swaps the env's graph state, so it stays on the caller's thread
+        self._load_and_merge_graph_tiles(bounds)
+
+    def _merge_graphs(self, graphs: List[nx.MultiDiGraph]) -> nx.MultiDiGraph:
+        """Merges tile graphs, reusing the graph itself when there is only one tile."""
+        if len(graphs) == 1:
+            return graphs[0]
+        # Copy the largest tile (tile graphs stay cached) and add the others into it
+        graphs = sorted(graphs, key=lambda g: g.number_of_nodes(), reverse=True)
+        merged = graphs[0].copy()
+        for g in graphs[1:]:
+            merged.update(edges=g.edges(keys=True, data=True), nodes=g.nodes(data=True))
+        return merged
+
+    def _merge_node_tables(self, tables: List[gpd.GeoDataFrame]) -> gpd.GeoDataFrame:
+        """Concatenates tile node tables, keeping the first row per osmid, indexed by osmid."""
+        if len(tables) == 1:
+            # A single tile's nodes are already unique
+            merged = tables[0]
+        else:
+            merged = gpd.pd.concat(tables, ignore_index=True).drop_duplicates(subset='osmid', keep='first')
+        return merged.set_index('osmid', drop=False)
+
     def _load_tile_graph(self, tile_bounds: Dict[str, float]) -> Optional[Dict[str, Any]]:
         """Loads graph data for a single tile from cache or OSM."""
-        print(f"--- _load_tile_graph ---")
-        print(f"Loading tile for bounds: {tile_bounds}")
+        logger.debug(f"Loading tile for bounds: {tile_bounds}")
         cache_path = self._get_cache_path(tile_bounds)
-        print(f"Cache path: {cache_path}")
+        logger.debug(f"Cache path: {cache_path}")
         
         
         if not self.force_osm_refresh and os.path.exists(cache_path) and os.path.getsize(cache_path) > 0:
-            print(f"Loading graph data from cache: {cache_path}")
             logger.info(f"Loading graph data from cache: {cache_path}")
             try:
-                with open(cache_path, 'r') as f:
-                    cached_data = json.load(f)
-                print("Successfully loaded data from cache file.")
+                with open(cache_path, 'rb') as f:
+                    cached_data = pickle.load(f)
             except Exception as e:
                 logger.error(f"Failed to load cache file {cache_path}: {e}")
                 logger.info(f"Falling back to OSM download")
-                print(f"Error loading from cache, falling back to OSM: {e}")
                 # Fall through to OSM download
             else:
-                print("Processing cached data.")
-                drive_graph_proj_data = cached_data['drive_graph_proj']
-                if 'crs_wkt' in drive_graph_proj_data['graph']:
-                    drive_graph_proj_data['graph']['crs'] = CRS.from_wkt(drive_graph_proj_data['graph']['crs_wkt'])
-                    del drive_graph_proj_data['graph']['crs_wkt']
-                drive_graph_proj = json_graph.node_link_graph(drive_graph_proj_data, directed=True, multigraph=True)
-
-                drive_graph_unproj_data = cached_data['drive_graph_unproj']
-                if 'crs_wkt' in drive_graph_unproj_data['graph']:
-                    drive_graph_unproj_data['graph']['crs'] = CRS.from_wkt(drive_graph_unproj_data['graph']['crs_wkt'])
-                    del drive_graph_unproj_data['graph']['crs_wkt']
-                drive_graph_unproj = json_graph.node_link_graph(drive_graph_unproj_data, directed=True, multigraph=True)
-
-                nodes_proj_geojson = cached_data['graph_gdf_nodes_proj']
-                graph_gdf_nodes_proj = gpd.GeoDataFrame.from_features(nodes_proj_geojson['features'])
-                if 'crs_wkt' in nodes_proj_geojson:
-                    graph_gdf_nodes_proj.crs = CRS.from_wkt(nodes_proj_geojson['crs_wkt'])
-
-                nodes_unproj_geojson = cached_data['graph_gdf_nodes_unproj']
-                graph_gdf_nodes_unproj = gpd.GeoDataFrame.from_features(nodes_unproj_geojson['features'])
-                if 'crs_wkt' in nodes_unproj_geojson:
-                    graph_gdf_nodes_unproj.crs = CRS.from_wkt(nodes_unproj_geojson['crs_wkt'])
-                
-                valid_vehicle_node_ids = cached_data['valid_vehicle_node_ids']
-                node_positions = {int(k): np.array(v) for k, v in cached_data['node_positions'].items()}
-                
-                print("Finished processing cached data. Returning.")
-                print(f"--- Finished _load_tile_graph (from cache) ---")
-                return {
-                    'drive_graph_proj': drive_graph_proj,
-                    'graph_gdf_nodes_proj': graph_gdf_nodes_proj,
-                    'drive_graph_unproj': drive_graph_unproj,
-                    'graph_gdf_nodes_unproj': graph_gdf_nodes_unproj,
-                    'valid_vehicle_node_ids': valid_vehicle_node_ids,
-                    'node_positions': node_positions,
-                }
+                # Graphs and node arrays are stored as-is; node tables need their points rebuilt
+                for key in NODE_TABLE_KEYS:
+                    cached_data[key] = _expand_nodes(cached_data[key])
+                return cached_data
+
+        if self.force_osm_refresh:
+            logger.debug("Forcing OSM refresh.")
+        elif not os.path.exists(cache_path):
+            logger.debug("Cache file does not exist.")
+        elif os.path.getsize(cache_path) <= 0:
+            logger.debug("Cache file is empty.")
+        
+        logger.info(f"Fetching graph data from OSM for tile: {tile_bounds}")
+        north, south, east, west = tile_bounds['maxLat'], tile_bounds['minLat'], tile_bounds['maxLng'], tile_bounds['minLng']
+        
+        try:
+            bbox = west, south, east, north
+            logger.debug(f"Requesting data from OSM with bbox: {bbox}")
+            G_unproj = ox.graph_from_bbox(bbox, network_type='drive', simplify=False, retain_all=True, truncate_by_edge=True)
+            G_unproj.graph['crs'] = CRS.from_user_input(G_unproj.graph['crs'])
+            logger.debug(f"Successfully fetched graph from OSM. Got {len(G_unproj.nodes)} nodes and {len(G_unproj.edges)} edges.")
+        except InsufficientResponseError:
+            logger.warning(f"No graph data found for tile {tile_bounds}. Caching empty tile.")
+            empty_graph_data = {
+                'drive_graph_proj': nx.MultiDiGraph(),
+                'graph_gdf_nodes_proj': gpd.GeoDataFrame({'osmid': [], 'geometry': []}, crs="EPSG:4326"),
+                'drive_graph_unproj': nx.MultiDiGraph(crs="epsg:4326"),
+                'graph_gdf_nodes_unproj': gpd.GeoDataFrame({'osmid': [], 'geometry': []}, crs="EPSG:4326"),
+                'valid_vehicle_node_ids': [],
+                'node_ids': np.empty(0, dtype=np.int64),
+                'node_xy': np.empty((0, 2), dtype=np.float64),
+            }
+            self._write_tile_cache(cache_path, empty_graph_data)
+            return empty_graph_data
 
-        else:
-            if self.force_osm_refresh:
-                print("Forcing OSM refresh.")
-            elif not os.path.exists(cache_path):
-                print("Cache file does not exist.")
-            elif os.path.getsize(cache_path) <= 0:
-                print("Cache file is empty.")
+        try:
+            logger.debug("Adding edge speeds and travel times.")
+            G_unproj = ox.add_edge_speeds(G_unproj)
+            G_unproj = ox.add_edge_travel_times(G_unproj)
+            logger.debug("Projecting graph.")
+            G_proj = ox.project_graph(G_unproj)
             
-            logger.info(f"Fetching graph data from OSM for tile: {tile_bounds}")
-            print(f"Fetching graph data from OSM for tile: {tile_bounds}")
-            north, south, east, west = tile_bounds['maxLat'], tile_bounds['minLat'], tile_bounds['maxLng'], tile_bounds['minLng']
+            logger.debug("Converting graph to GeoDataFrames.")
+            nodes_proj, edges_proj = ox.graph_to_gdfs(G_proj, nodes=True, edges=True)
+            nodes_proj.reset_index(inplace=True)
+            nodes_unproj, edges_unproj = ox.graph_to_gdfs(G_unproj, nodes=True, edges=True)
+            nodes_unproj.reset_index(inplace=True)
+
+            logger.debug("Extracting node positions.")
+            node_ids = np.fromiter(G_unproj.nodes, dtype=np.int64, count=G_unproj.number_of_nodes())
+            node_xy = np.empty((len(node_ids), 2), dtype=np.float64)
+            for i, (_, data) in enumerate(G_unproj.nodes(data=True)):
+                node_xy[i, 0] = data['y']
+                node_xy[i, 1] = data['x']
+            valid_vehicle_node_ids = node_ids.tolist()
             
-            try:
-                bbox = west, south, east, north
-                print(f"Requesting data from OSM with bbox: {bbox}")
-                G_unproj = ox.graph_from_bbox(bbox, network_type='drive', simplify=False, retain_all=True, truncate_by_edge=True)
-                print(f"--- INITIAL GRAPH FROM OSM ---")
-                print(f"Graph attributes: {G_unproj.graph}")
-                G_unproj.graph['crs'] = CRS.from_user_input(G_unproj.graph['crs'])
-                print(f"Successfully fetched graph from OSM. Got {len(G_unproj.nodes)} nodes and {len(G_unproj.edges)} edges.")
-            except InsufficientResponseError:
-                logger.warning(f"No graph data found for tile {tile_bounds}. Caching empty tile.")
-                print(f"No graph data found for tile {tile_bounds}. Caching empty tile.")
-                empty_graph_data = {
-                    'drive_graph_proj': json_graph.node_link_data(nx.MultiDiGraph()),
-                    'graph_gdf_nodes_proj': json.loads(gpd.GeoDataFrame({'osmid': [], 'geometry': []}, crs="EPSG:4326").to_json()),
-                    'drive_graph_unproj': json_graph.node_link_data(nx.MultiDiGraph(crs="epsg:4326")),
-                    'graph_gdf_nodes_unproj': json.loads(gpd.GeoDataFrame({'osmid': [], 'geometry': []}, crs="EPSG:4326").to_json()),
-                    'valid_vehicle_node_ids': [],
-                    'node_positions': {},
-                }
-                with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as tmp_file:
-                    json.dump(empty_graph_data, tmp_file, cls=NpEncoder)
-                    temp_path = tmp_file.name
-                shutil.move(temp_path, cache_path)
-                print(f"--- Finished _load_tile_graph (empty tile) ---")
-                return {
-                    'drive_graph_proj': nx.MultiDiGraph(),
-                    'graph_gdf_nodes_proj': gpd.GeoDataFrame({'osmid': [], 'geometry': []}, crs="EPSG:4326"),
-                    'drive_graph_unproj': nx.MultiDiGraph(crs="epsg:4326"),
-                    'graph_gdf_nodes_unproj': gpd.GeoDataFrame({'osmid': [], 'geometry': []}, crs="EPSG:4326"),
-                    'valid_vehicle_node_ids': [],
-                    'node_positions': {},
-                }
+            tile_data = {
+                'drive_graph_proj': G_proj,
+                'graph_gdf_nodes_proj': nodes_proj,
+                'drive_graph_unproj': G_unproj,
+                'graph_gdf_nodes_unproj': nodes_unproj,
+                'valid_vehicle_node_ids': valid_vehicle_node_ids,
+                'node_ids': node_ids,
+                'node_xy': node_xy,
+            }
+            
+            logger.debug("Writing data to cache file...")
+            self._write_tile_cache(cache_path, tile_data)
+            logger.info(f"Saved graph data to cache: {cache_path}")
 
-            try:
-                print("Adding edge speeds and travel times.")
-                G_unproj = ox.add_edge_speeds(G_unproj)
-                G_unproj = ox.add_edge_travel_times(G_unproj)
-                print("Projecting graph.")
-                G_proj = ox.project_graph(G_unproj)
-                
-                print("Converting graph to GeoDataFrames.")
-                nodes_proj, edges_proj = ox.graph_to_gdfs(G_proj, nodes=True, edges=True)
-                nodes_proj.reset_index(inplace=True)
-                nodes_unproj, edges_unproj = ox.graph_to_gdfs(G_unproj, nodes=True, edges=True)
-                nodes_unproj.reset_index(inplace=True)
-
-                print("Extracting node positions.")
-                node_positions = {node_id: np.array([data['y'], data['x']]) for node_id, data in G_unproj.nodes(data=True)}
-                valid_vehicle_node_ids = list(node_positions.keys())
-                
-                print("Serializing graph data for caching.")
-                drive_graph_proj_data = json_graph.node_link_data(G_proj)
-                if 'crs' in drive_graph_proj_data['graph']:
-                    drive_graph_proj_data['graph']['crs_wkt'] = drive_graph_proj_data['graph']['crs'].to_wkt()
-                    del drive_graph_proj_data['graph']['crs']
-
-                drive_graph_unproj_data = json_graph.node_link_data(G_unproj)
-                if 'crs' in drive_graph_unproj_data['graph']:
-                    drive_graph_unproj_data['graph']['crs_wkt'] = drive_graph_unproj_data['graph']['crs'].to_wkt()
-                    del drive_graph_unproj_data['graph']['crs']
-                
-                graph_gdf_nodes_proj_geojson = json.loads(nodes_proj.to_json())
-                graph_gdf_nodes_unproj_geojson = json.loads(nodes_unproj.to_json())
-
-                data_to_cache = {
-                    'drive_graph_proj': drive_graph_proj_data,
-                    'graph_gdf_nodes_proj': graph_gdf_nodes_proj_geojson,
-                    'drive_graph_unproj': drive_graph_unproj_data,
-                    'graph_gdf_nodes_unproj': graph_gdf_nodes_unproj_geojson,
-                    'valid_vehicle_node_ids': valid_vehicle_node_ids,
-                    'node_positions': {k: v.tolist() for k, v in node_positions.items()},
-                }
-                
-                print(f"Writing data to temporary cache file...")
-                with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as tmp_file:
-                    json.dump(data_to_cache, tmp_file, cls=NpEncoder)
-                    temp_path = tmp_file.name
-                
-                shutil.move(temp_path, cache_path)
-                logger.info(f"Saved graph data to cache: {cache_path}")
-                print(f"Saved graph data to cache: {cache_path}")
-
-                print("Finished processing data from OSM. Returning.")
-                print(f"--- Finished _load_tile_graph (from OSM) ---")
-                return {
-                    'drive_graph_proj': G_proj,
-                    'graph_gdf_nodes_proj': nodes_proj,
-                    'drive_graph_unproj': G_unproj,
-                    'graph_gdf_nodes_unproj': nodes_unproj,
-                    'valid_vehicle_node_ids': valid_vehicle_node_ids,
-                    'node_positions': node_positions,
-                }
-            except Exception as e:
-                logger.exception(f"Failed to process graph for tile {tile_bounds}: {e}")
-                print(f"Error processing graph for tile {tile_bounds}: {e}")
-                print(f"--- Finished _load_tile_graph (with error) ---")
-                return None
+            return tile_data
+        except Exception as e:
+            logger.exception(f"Failed to process graph for tile {tile_bounds}: {e}")
+            return None
+
+    def _write_tile_cache(self, cache_path: str, tile_data: Dict[str, Any]):
+        """Atomically pickles a tile's graphs and node tables to the cache file."""
+        data_to_cache = dict(tile_data)
+        for key in NODE_TABLE_KEYS:
+            data_to_cache[key] = _compact_nodes(tile_data[key])
+        # Write next to the target so the final move is a same-filesystem rename
+        with tempfile.NamedTemporaryFile(mode='wb', delete=False, dir=self.cache_dir, suffix='.tmp') as tmp_file:
+            pickle.dump(data_to_cache, tmp_file, protocol=5)
+            temp_path = tmp_file.name
+        shutil.move(temp_path, cache_path)
     
     def _initialize_traffic_lights(self):
         """Initializes traffic light states and cycle times."""
-        print("--- _initialize_traffic_lights ---")
-        if not self.show_traffic_lights or not hasattr(self, 'traffic_signals'):
-            print("Not initializing traffic lights. show_traffic_lights:", self.show_traffic_lights, "hasattr(traffic_signals):", hasattr(self, 'traffic_signals'))
-            if hasattr(self, 'traffic_signals'):
-                print("Traffic signals count:", len(self.traffic_signals))
-            return
-        
-        print(f"Initializing {len(self.traffic_signals)} traffic signals.")
-        self.traffic_light_states = {}  # node_id -> 'red' or 'green'
-        self.traffic_light_timers = {}  # node_id -> time_in_current_state
-        self.traffic_light_cycle_times = {} # node_id -> {'red': duration, 'green': duration}
-
-        for node_id in self.traffic_signals:
-            # Randomly assign initial state
-            self.traffic_light_states[node_id] = np.random.choice(['red', 'green'])
-            self.traffic_light_timers[node_id] = 0
-            # Assign random cycle times for red and green lights
-            self.traffic_light_cycle_times[node_id] = {
-                'red': np.random.randint(20, 40),
-                'green': np.random.randint(20, 40)
-            }
-            print(f"  - Initialized light {node_id}: state={self.traffic_light_states[node_id]}")
+        # With lights hidden the arrays are still built, just empty, so step() can always tick them
+        signals = self.traffic_signals if self.show_traffic_lights else set()
+        if not self.show_traffic_lights:
+            logger.debug("Traffic lights hidden, not initializing any.")
         
-        print("---------------------------------")
+        logger.debug(f"Initializing {len(signals)} traffic signals.")
+        # One row per light, so the per-step tick runs as a single compiled loop
+        num_lights = len(signals)
+        self._tl_node_ids = np.fromiter(signals, dtype=np.int64, count=num_lights)
+        self._tl_rows = np.fromiter((self._nid_to_idx[node_id] for node_id in self._tl_node_ids.tolist()), dtype=np.intp, count=num_lights)
+        # Random initial states and red/green cycle times, drawn for all lights at once
+        self._tl_state = self._rng.integers(TL_RED, TL_GREEN + 1, size=num_lights, dtype=np.int8)
+        self._tl_timer = np.zeros(num_lights, dtype=np.int32)  # steps spent in the current state
+        self._tl_cycle = self._rng.integers(20, 40, size=(num_lights, 2), dtype=np.int32)  # columns: TL_RED, TL_GREEN
+        # 1 at the node row of every red light, so agents check the node ahead with a single array read
+        self._node_red = np.zeros(len(self._node_ids), dtype=np.uint8)
+        self._node_red[self._tl_rows] = self._tl_state == TL_RED
+        # The lights were redrawn, so every waiting agent looks at its light again
+        self._wait_head = np.full(len(self._node_ids), -1, dtype=np.intp)
+        if hasattr(self, '_stopped'):
+            self._stopped[:] = False
     
-    def update_bounds(self, bounds: Dict[str, float], show_traffic_lights: bool, show_traffic_lanes: bool):
+    async def update_bounds(self, bounds: Dict[str, float], show_traffic_lights: bool, show_traffic_lanes: bool):
         """Dynamically updates the environment's bounds and reloads graph data."""
         logger.info(f"Updating environment bounds to {bounds}")
         old_show_traffic_lights = self.show_traffic_lights
@@ -471,48 +749,46 @@ class DriveGraphEnv:
         
         # Only reload if we need new tiles
         self.bounds = bounds
-        self._load_and_merge_graph_tiles(bounds)
+        await self._load_and_merge_graph_tiles_async(bounds)
+        self._remap_agents()
         self._initialize_traffic_lights()
         if self.show_traffic_lanes:
             self.road_network_data = self.get_road_network_data()
 
     def _load_traffic_signals_for_bbox(self):
         """Loads traffic signals for the current bounds using bbox approach similar to drive graph."""
-        print("--- _load_traffic_signals_for_bbox ---")
-        
         # Use the same bounds as the drive graph
         north, south, east, west = self.bounds['maxLat'], self.bounds['minLat'], self.bounds['maxLng'], self.bounds['minLng']
 
         # BBOX MUST ALWAYS BE (left, bottom, right, top).
         bbox = (west, south, east, north)
-        print(f"Querying traffic signals for bbox: {bbox}")
+        logger.debug(f"Querying traffic signals for bbox: {bbox}")
         
         try:
             # Get traffic signals within the bounding box
             tags = {"highway": "traffic_signals"}
-            print(f"Querying OSM for traffic signals with tags: {tags} and bbox: {bbox}")
+            logger.debug(f"Querying OSM for traffic signals with tags: {tags} and bbox: {bbox}")
             traffic_signals_gdf = ox.features_from_bbox(bbox, tags)
-            print(f"Found {len(traffic_signals_gdf)} potential traffic signal features from OSM.")
+            logger.debug(f"Found {len(traffic_signals_gdf)} potential traffic signal features from OSM.")
             
             if not traffic_signals_gdf.empty and self.drive_graph_unproj.nodes:
                 # Find the nearest nodes in the graph to the traffic signal points
-                traffic_signal_points = traffic_signals_gdf[traffic_signals_gdf.geom_type == 'Point']
-                print(f"Found {len(traffic_signal_points)} traffic signals that are points.")
+                # get_type_id is a single vectorized GEOS call; 0 is Point
+                is_point = shapely.get_type_id(traffic_signals_gdf.geometry.values) == 0
+                traffic_signal_points = traffic_signals_gdf[is_point]
+                logger.debug(f"Found {len(traffic_signal_points)} traffic signals that are points.")
                 if not traffic_signal_points.empty:
-                    nearest_nodes = ox.nearest_nodes(self.drive_graph_unproj, X=traffic_signal_points.geometry.x, Y=traffic_signal_points.geometry.y)
-                    self.traffic_signals.update(nearest_nodes)
+                    signal_xy = np.column_stack([traffic_signal_points.geometry.y.to_numpy(), traffic_signal_points.geometry.x.to_numpy()])
+                    _, nearest_idx = self._node_kdtree.query(signal_xy, k=1)
+                    nearest_nodes = self._node_ids[nearest_idx]
+                    self.traffic_signals.update(nearest_nodes.tolist())
                     logger.info(f"Loaded {len(nearest_nodes)} traffic signals.")
-                    print(f"Loaded {len(nearest_nodes)} traffic signals and added to self.traffic_signals.")
-                    print(f"Total traffic signals so far: {len(self.traffic_signals)}")
+                    logger.debug(f"Total traffic signals so far: {len(self.traffic_signals)}")
 
         except InsufficientResponseError:
             logger.info("No traffic signals found in the bbox.")
-            print("No traffic signals found in the bbox (InsufficientResponseError).")
         except Exception as e:
             logger.error(f"Failed to load traffic signals: {e}")
-            print(f"An exception occurred while loading traffic signals: {e}")
-        
-        print("---------------------------------------------")
 
     def get_road_network_data(self, radius_km=1):
         """
@@ -525,72 +801,203 @@ class DriveGraphEnv:
         center_lat = (self.bounds['minLat'] + self.bounds['maxLat']) / 2
         center_lng = (self.bounds['minLng'] + self.bounds['maxLng']) / 2
         
-        # Create a buffer zone around the center point
-        center_point = Point(center_lng, center_lat)
-        
-        # Project to a local CRS to buffer in meters
-        gdf_point = gpd.GeoDataFrame([1], geometry=[center_point], crs="EPSG:4326")
-        projected_point_gdf = gdf_point.to_crs(gdf_point.estimate_utm_crs())
-        buffer = projected_point_gdf.buffer(radius_km * 1000).to_crs("EPSG:4326").iloc[0]
+        # Create a buffer zone around the center point. At city scale a circle in meters is an
+        # ellipse in degrees, so scale a unit circle instead of round-tripping through UTM
+        # Meters per degree on the WGS84 ellipsoid at this latitude
+        phi = math.radians(center_lat)
+        m_per_deg_lat = 111132.92 - 559.82 * math.cos(2 * phi) + 1.175 * math.cos(4 * phi)
+        m_per_deg_lng = 111412.84 * math.cos(phi) - 93.5 * math.cos(3 * phi)
+        radius_lat = radius_km * 1000 / m_per_deg_lat
+        radius_lng = radius_km * 1000 / m_per_deg_lng
+        buffer = affinity.scale(Point(center_lng, center_lat).buffer(1.0), xfact=radius_lng, yfact=radius_lat)
         
-        _, edges_gdf = ox.graph_to_gdfs(self.drive_graph_unproj)
-        
-        # Filter edges that are within the buffer
-        edges_in_radius = edges_gdf[edges_gdf.geometry.within(buffer)]
+        # Filter edges that are within the buffer; sorting keeps the graph's edge order
+        hits = np.sort(self._edges_sindex.query(buffer, predicate='contains'))
+        edges_in_radius = self._edges_gdf_unproj.iloc[hits]
 
         if edges_in_radius.empty:
             return {"type": "FeatureCollection", "features": []}
 
         # Convert to GeoJSON
-        return json.loads(edges_in_radius.to_json())
+        return orjson.loads(edges_in_radius.to_json())
 
 
     def _generate_snapped_bounds(self, bounds: Dict[str, float], snap_resolution: float) -> Dict[str, float]:
-        snapped_min_lat = math.floor(bounds["minLat"] / snap_resolution) * snap_resolution
-        snapped_max_lat = math.ceil(bounds["maxLat"] / snap_resolution) * snap_resolution
-        snapped_min_lng = math.floor(bounds["minLng"] / snap_resolution) * snap_resolution
-        snapped_max_lng = math.ceil(bounds["maxLng"] / snap_resolution) * snap_resolution
+        # Snap in integer micro-degrees: floor division is exact, so a bound that already sits
+        # on the grid (e.g. 37.80 with 0.05) isn't pushed a whole tile out by float rounding
+        q = round(snap_resolution * MICRODEGREES)
+        snapped_min_lat = round(bounds["minLat"] * MICRODEGREES) // q
+        snapped_max_lat = -(-round(bounds["maxLat"] * MICRODEGREES) // q)
+        snapped_min_lng = round(bounds["minLng"] * MICRODEGREES) // q
+        snapped_max_lng = -(-round(bounds["maxLng"] * MICRODEGREES) // q)
         
         if snapped_max_lat <= snapped_min_lat:
-            snapped_max_lat = snapped_min_lat + snap_resolution
+            snapped_max_lat = snapped_min_lat + 1
         if snapped_max_lng <= snapped_min_lng:
-            snapped_max_lng = snapped_min_lng + snap_resolution
+            snapped_max_lng = snapped_min_lng + 1
 
         return {
-            "minLat": snapped_min_lat,
-            "maxLat": snapped_max_lat,
-            "minLng": snapped_min_lng,
-            "maxLng": snapped_max_lng,
+            "minLat": snapped_min_lat * q / MICRODEGREES,
+            "maxLat": snapped_max_lat * q / MICRODEGREES,
+            "minLng": snapped_min_lng * q / MICRODEGREES,
+            "maxLng": snapped_max_lng * q / MICRODEGREES,
         }
 
+    def _build_node_arrays(self, all_node_ids: List[np.ndarray], all_node_xy: List[np.ndarray]):
+        """Merges per-tile node arrays into one (N, 2) [lat, lng] buffer plus an id -> row index."""
+        if len(all_node_ids) == 1:
+            self._node_ids, self._node_xy = all_node_ids[0], all_node_xy[0]
+        elif all_node_ids:
+            node_ids = np.concatenate(all_node_ids)
+            # Tiles can share border nodes; keep the first row for each id
+            _, first = np.unique(node_ids, return_index=True)
+            first.sort()
+            self._node_ids = node_ids[first]
+            self._node_xy = np.concatenate(all_node_xy)[first]
+        else:
+            self._node_ids = np.empty(0, dtype=np.int64)
+            self._node_xy = np.empty((0, 2), dtype=np.float64)
+        self._nid_to_idx = dict(zip(self._node_ids.tolist(), range(len(self._node_ids))))
+        self._bounds_idx_buf = np.empty(len(self._node_ids), dtype=np.int64)
+        # Built once per merge and reused for every nearest-node lookup
+        self._node_kdtree = cKDTree(self._node_xy)
+        # Computed once per merge and reused by every viewport query
+        self._valid_mask = _sorted_contains(self.valid_vehicle_node_ids, self._node_ids)
+        self._bounds_cache = None  # (bounds key, node ids) from _nodes_in_bounds_cached
+
+    def _build_routing_graph(self):
+        """Builds a CSR adjacency matrix over node rows, weighted by edge length.
+
+        Alongside it, _edge_speed_deg holds each stored edge's speed limit in degrees
+        per step, aligned with the CSR data array.
+        """
+        num_nodes = len(self._node_ids)
+        edges = [
+            (
+                self._nid_to_idx[u], self._nid_to_idx[v],
+                data.get('length') or 0.0,
+                data.get('speed_kph', 30),  # Default to 30 kph if not available
+            )
+            for u, v, data in self.drive_graph_unproj.edges(data=True)
+        ]
+        if not edges:
+            self._routing_csr = csr_matrix((num_nodes, num_nodes))
+            self._edge_speed_deg = np.empty(0, dtype=np.float64)
+            return
+        rows, cols, lengths, speeds_kph = (np.asarray(column) for column in zip(*edges))
+        # csr_matrix would sum parallel edges; keep the shortest of each (u, v) instead
+        order = np.lexsort((lengths, cols, rows))
+        rows, cols, lengths, speeds_kph = rows[order], cols[order], lengths[order], speeds_kph[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        # Zero weights would read as missing edges
+        lengths = np.maximum(lengths[first].astype(np.float64), 1e-6)
+        # Already sorted by (row, col), so the arrays go in as CSR directly and stay aligned with the speeds
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[first], minlength=num_nodes), out=indptr[1:])
+        self._routing_csr = csr_matrix((lengths, cols[first], indptr), shape=(num_nodes, num_nodes))
+        # kph to meters per second, then to degrees per step assuming 1 degree = 111.32 km
+        self._edge_speed_deg = speeds_kph[first].astype(np.float64) * (1000 / 3600) / (111.32 * 1000)
+
+    def _start_hub_routes(self):
+        """Picks routing hubs among the valid nodes and computes their routes on a background thread."""
+        self._hub_routes = None
+        valid_rows = np.flatnonzero(self._valid_mask)
+        if len(valid_rows) < 2:
+            return
+        # Two int32 predecessor rows per hub, one over the full node set each
+        num_hubs = min(MAX_ROUTING_HUBS, len(valid_rows), max(1, HUB_ROUTES_MEMORY_BYTES // (8 * len(self._node_ids))))
+        hub_rows = np.sort(self._rng.choice(valid_rows, size=num_hubs, replace=False))
+        threading.Thread(target=self._build_hub_routes, args=(self._routing_csr, hub_rows), daemon=True).start()
+
+    def _build_hub_routes(self, routing_csr: csr_matrix, hub_rows: np.ndarray):
+        """Single-source Dijkstra from and to every hub, kept as predecessor rows for path lookup.
+
+        csgraph's dijkstra holds the GIL for a whole call, so each hub gets its own call
+        and the event loop runs in between, instead of stalling for the full build.
+        """
+        # On the reversed graph, a node's predecessor is its next hop towards the hub
+        reversed_csr = routing_csr.T.tocsr()
+        pred_from_hub = np.empty((len(hub_rows), routing_csr.shape[0]), dtype=np.int32)
+        pred_to_hub = np.empty_like(pred_from_hub)
+        for i, hub_row in enumerate(hub_rows.tolist()):
+            # Stop early if the tiles were re-merged while this ran
+            if self._routing_csr is not routing_csr:
+                return
+            pred_from_hub[i] = dijkstra(routing_csr, indices=hub_row, return_predecessors=True)[1]
+            time.sleep(0)
+            pred_to_hub[i] = dijkstra(reversed_csr, indices=hub_row, return_predecessors=True)[1]
+            time.sleep(0)
+        if self._routing_csr is routing_csr:
+            # The graph goes in with the routes, since a re-merge may land between the check and this write
+            self._hub_routes = (routing_csr, hub_rows, pred_from_hub, pred_to_hub)
+            logger.info(f"Precomputed routes for {len(hub_rows)} hubs.")
+
+    def _route_via_hub(self, node_id: int) -> Optional[np.ndarray]:
+        """Node rows of a path between node_id and a random hub in the viewport (either direction), or None if there's none."""
+        hub_routes = self._hub_routes
+        if hub_routes is None or hub_routes[0] is not self._routing_csr:
+            return None
+        _, hub_rows, pred_from_hub, pred_to_hub = hub_routes
+        hub_xy = self._node_xy[hub_rows]
+        in_view = np.flatnonzero(
+            (hub_xy[:, 0] >= self.bounds['minLat']) & (hub_xy[:, 0] <= self.bounds['maxLat']) &
+            (hub_xy[:, 1] >= self.bounds['minLng']) & (hub_xy[:, 1] <= self.bounds['maxLng'])
+        )
+        if not len(in_view):
+            return None
+        hub = in_view[self._rng.integers(len(in_view))]
+        to_hub = bool(self._rng.integers(2))
+        pred = (pred_to_hub if to_hub else pred_from_hub)[hub]
+        hub_row = int(hub_rows[hub])
+        row = self._nid_to_idx[int(node_id)]
+        if row == hub_row:
+            return None
+        rows = _trace_predecessors(pred, row, hub_row)
+        if rows is None:
+            return None
+        if not to_hub:
+            rows.reverse()
+        return np.array(rows, dtype=np.intp)
+
     def get_nodes_in_bounds(self, bounds: Dict[str, float]) -> List[int]:
         """Returns a list of node IDs within the given bounding box."""
-        if not self.node_positions:
-            return []
-
-        valid_nodes_set = set(self.valid_vehicle_node_ids)
-        nodes_in_bounds = []
-
-        for node_id, pos in self.node_positions.items():
-            if node_id in valid_nodes_set:
-                # pos is [latitude, longitude]
-                if bounds['minLat'] <= pos[0] <= bounds['maxLat'] and \
-                   bounds['minLng'] <= pos[1] <= bounds['maxLng']:
-                    nodes_in_bounds.append(node_id)
-        
-        return nodes_in_bounds
+        return self._node_ids_in_bounds(bounds).tolist()
+
+    def _node_ids_in_bounds(self, bounds: Dict[str, float]) -> np.ndarray:
+        """Array of the valid node IDs within the given bounding box."""
+        count = _filter_bounds(
+            self._node_xy, self._valid_mask,
+            bounds['minLat'], bounds['maxLat'], bounds['minLng'], bounds['maxLng'],
+            self._bounds_idx_buf,
+        )
+        return self._node_ids[self._bounds_idx_buf[:count]]
+
+    def _nodes_in_bounds_cached(self) -> np.ndarray:
+        """Valid node IDs within self.bounds, recomputed only when the bounds or the merged graph change."""
+        key = (self.bounds['minLat'], self.bounds['maxLat'], self.bounds['minLng'], self.bounds['maxLng'])
+        if self._bounds_cache is None or self._bounds_cache[0] != key:
+            self._bounds_cache = (key, self._node_ids_in_bounds(self.bounds))
+        return self._bounds_cache[1]
 
 
     async def reset(self, seed=None) -> Dict[str, Any]:
         if seed is not None:
-            np.random.seed(seed)
+            self._rng = np.random.default_rng(seed)
         
         self.steps = 0
         self.agents = {}
         self.active_agents = set()
+        self._active[:] = False
+        self._routed[:] = False
+        self._spawning[:] = False
+        self._stopped[:] = False
+        self._wait_dirty = True
+        self._slot_agents = [None] * self.max_agents
+        self._free_slots = []
+        self._next_slot = 0
         self.next_agent_id = 0
-        for _ in range(self.num_agents):
-            await self.add_agent()
+        await self._add_agents(self.num_agents)
         
         observations = {}
         infos = {}
@@ -599,6 +1006,19 @@ class DriveGraphEnv:
         return observations, infos
     
     async def add_agent(self) -> Optional[str]:
+        agent_state = self._create_agent()
+        if agent_state is None:
+            return None
+        await self._spawn_agent(agent_state)
+        return agent_state.agent_id
+
+    async def _add_agents(self, count: int):
+        """Adds count agents, running their respawns concurrently so their Dijkstra searches share the thread pool."""
+        new_agents = [agent for agent in (self._create_agent() for _ in range(count)) if agent is not None]
+        await asyncio.gather(*(self._spawn_agent(agent) for agent in new_agents))
+
+    def _create_agent(self) -> Optional[AgentState]:
+        """Registers a new agent in a free slot, without a path yet."""
         if len(self.agents) >= self.max_agents:
             logger.warning(f"Max agent count reached ({self.max_agents})")
             return None
@@ -606,28 +1026,54 @@ class DriveGraphEnv:
         agent_id = f"vehicle_{self.next_agent_id}"
         self.next_agent_id += 1
         
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            slot = self._next_slot
+            self._next_slot += 1
+        self._pos[slot] = 0
+        self._vel[slot] = 0
+        self._goal[slot] = 0
+        self._active[slot] = True
+        self._routed[slot] = False
+        self._spawning[slot] = True
+        
         agent_state = AgentState(
             agent_id=agent_id,
-            position=np.zeros(2, dtype=np.float32),
-            velocity=np.zeros(2, dtype=np.float32),
-            goal=np.zeros(2, dtype=np.float32),
+            slot=slot,
+            positions=self._pos,
+            velocities=self._vel,
+            goals=self._goal,
+            path_indices=self._path_index,
             path=None,
             path_index=0
         )
 
         self.agents[agent_id] = agent_state
+        self._slot_agents[slot] = agent_state
         self.active_agents.add(agent_id)
-        
-        await self.respawn_agent(agent_state)
+        return agent_state
+
+    async def _spawn_agent(self, agent_state: AgentState):
+        try:
+            await self.respawn_agent(agent_state)
+        finally:
+            # The slot may have been removed and handed to another agent meanwhile
+            if self._slot_agents[agent_state.slot] is agent_state:
+                self._spawning[agent_state.slot] = False
         
         if agent_state.path is None:
-            logger.warning(f"Could not find an initial path for agent {agent_id}. It will be respawned in the next step.")
-
-        return agent_id
+            logger.warning(f"Could not find an initial path for agent {agent_state.agent_id}. It will be respawned in the next step.")
     
     def remove_agent(self, agent_id: str) -> bool:
         if agent_id in self.agents:
-            del self.agents[agent_id]
+            agent = self.agents.pop(agent_id)
+            self._unstop(agent.slot)
+            self._active[agent.slot] = False
+            self._routed[agent.slot] = False
+            self._spawning[agent.slot] = False
+            self._slot_agents[agent.slot] = None
+            self._free_slots.append(agent.slot)
             if agent_id in self.active_agents:
                 self.active_agents.remove(agent_id)
             return True
@@ -642,8 +1088,7 @@ class DriveGraphEnv:
         diff = new_num_agents - current_agent_count
 
         if diff > 0:
-            for _ in range(diff):
-                await self.add_agent()
+            await self._add_agents(diff)
             logger.info(f"Added {diff} new agents. Total: {len(self.agents)}")
         elif diff < 0:
             agents_to_remove_count = abs(diff)
@@ -651,7 +1096,7 @@ class DriveGraphEnv:
                 logger.warning(f"Cannot remove {agents_to_remove_count} agents, only {current_agent_count} exist.")
                 agents_to_remove = list(self.agents.keys())
             else:
-                agents_to_remove = np.random.choice(list(self.agents.keys()), size=agents_to_remove_count, replace=False).tolist()
+                agents_to_remove = self._rng.choice(list(self.agents.keys()), size=agents_to_remove_count, replace=False).tolist()
 
             for agent_id in agents_to_remove:
                 self.remove_agent(agent_id)
@@ -660,169 +1105,234 @@ class DriveGraphEnv:
     async def step(self):
         self.steps += 1
 
-        # Update traffic lights
-        for node_id, timer in self.traffic_light_timers.items():
-            self.traffic_light_timers[node_id] += 1
-            current_state = self.traffic_light_states[node_id]
-            cycle_time = self.traffic_light_cycle_times[node_id][current_state]
-            if self.traffic_light_timers[node_id] >= cycle_time:
-                self.traffic_light_timers[node_id] = 0
-                self.traffic_light_states[node_id] = 'green' if current_state == 'red' else 'red'
+        if self._wait_dirty:
+            _link_waiting(self._stopped[:self._next_slot], self._next_row, self._wait_head, self._wait_next)
+            self._wait_dirty = False
+
+        # Update traffic lights, releasing the agents waiting at the ones that turn green
+        _tick_traffic_lights(
+            self._tl_state, self._tl_timer, self._tl_cycle, self._tl_rows, self._node_red,
+            self._wait_head, self._wait_next, self._stopped,
+        )
         
-        for agent_id in list(self.active_agents):
-            agent = self.agents.get(agent_id)
-            if not agent:
-                continue
+        # Agents without a path (none was found when they spawned) try again first. Agents still
+        # spawning are left to their own respawn. Routed and spawning agents are disjoint subsets of
+        # the active ones, so when the counts add up there are none and the scan is skipped
+        active = self._active[:self._next_slot]
+        routed = self._routed[:self._next_slot]
+        spawning = self._spawning[:self._next_slot]
+        if np.count_nonzero(active) != np.count_nonzero(routed) + np.count_nonzero(spawning):
+            for slot in np.flatnonzero(active & ~routed & ~spawning).tolist():
+                # An earlier respawn's await may have let set_num_agents remove this one, or hand its slot to a new agent
+                agent = self._slot_agents[slot]
+                if agent is not None and not self._spawning[slot]:
+                    await self.respawn_agent(agent)
+
+        # Move every routed agent towards its next node in one compiled, multithreaded pass
+        _advance(
+            self._routed[:self._next_slot], self._stopped, self._pos, self._vel, self._node_xy, self._next_row, self._speed,
+            self._edge_dir, self._remaining, self._node_red, self._events[:self._next_slot],
+        )
+        num_arrived = _collect_events(
+            self._events[:self._next_slot], self._next_row, self._wait_head, self._wait_next, self._arrived_buf
+        )
 
-            if not agent.path:
-                await self.respawn_agent(agent)
-                if not agent.path:
-                    continue
-            
+        # Arrivals are rare per step, so only they go back to Python
+        finished = []
+        advanced = []
+        for slot in self._arrived_buf[:num_arrived].tolist():
+            agent = self._slot_agents[slot]
+            agent.path_index += 1
             if agent.path_index >= len(agent.path) - 1:
-                self.remove_agent(agent_id)
-                await self.add_agent()
-            
-            current_node_id = agent.path[agent.path_index]
-            next_node_id = agent.path[agent.path_index + 1]
-            
-            # get edge data
-            edge_data = self.drive_graph_proj.get_edge_data(current_node_id, next_node_id)
-            if not edge_data:
-                continue
-            edge_data = edge_data[0] # For multigraphs, there might be multiple edges. We take the first one.
-
-            speed_limit_kph = edge_data.get('speed_kph', 30) # Default to 30 kph if not available
-            max_speed_this_step = speed_limit_kph * 1000 / 3600  # Convert kph to meters per second
-            
-            # Convert max_speed_this_step to degrees per step, assuming 1 degree = 111.32 km
-            max_speed_degrees = max_speed_this_step / (111.32 * 1000)
+                finished.append(agent.agent_id)
+            else:
+                self._set_next_target(agent)
+                advanced.append(slot)
+        self._start_edges(advanced)
+
+        # Agents at the end of their path are replaced after the pass, so slots never change under it
+        for agent_id in finished:
+            self.remove_agent(agent_id)
+        if finished:
+            await self._add_agents(len(finished))
+        
+        return self.observe_all()
 
-            current_node_pos = self.get_node_position(current_node_id)
-            next_node_pos = self.get_node_position(next_node_id)
-            
-            if current_node_pos is None or next_node_pos is None:
-                continue
+    def observe_all(self) -> torch.Tensor:
+        """Returns a (num_agents, 6) float32 tensor of [position, velocity, goal], one row per agent in slot order.
 
-            direction_vector = next_node_pos - agent.position
-            distance = np.linalg.norm(direction_vector)
+        The tensor shares a buffer that the next call overwrites; clone it to keep it.
+        """
+        count = _gather_observations(self._active[:self._next_slot], self._pos, self._vel, self._goal, self._obs_buf)
+        return torch.from_numpy(self._obs_buf[:count])
+
+    def _set_next_target(self, agent: AgentState):
+        """Points the agent's row of the step arrays at the next node on its path."""
+        slot = agent.slot
+        self._next_row[slot] = agent.path_rows[agent.path_index + 1]
+        self._speed[slot] = agent.path_speeds[agent.path_index]
+        self._unstop(slot)
+
+    def _start_edges(self, slots: List[int]):
+        """Measures the edge ahead of each given agent once, so stepping along it needs no norm."""
+        _measure_edges(
+            np.array(slots, dtype=np.intp), self._pos, self._node_xy, self._next_row, self._edge_dir, self._remaining
+        )
 
-            
-            # Check for traffic lights
-            if next_node_id in self.traffic_signals and self.traffic_light_states.get(next_node_id) == 'red':
-                agent.velocity = np.zeros(2, dtype=np.float32)
-            else:
-                if distance > 0:
-                    agent.velocity = (direction_vector / distance) * max_speed_degrees
-            
-            if distance < max_speed_degrees:
-                agent.position = next_node_pos
-                agent.path_index += 1
-                
-                if agent.path_index >= len(agent.path) - 1:
-                    self.remove_agent(agent_id)
-                    await self.add_agent()
+    def _unstop(self, slot: int):
+        """Releases an agent waiting at a red light without its light turning green."""
+        if self._stopped[slot]:
+            self._stopped[slot] = False
+            self._wait_dirty = True
+
+    def _remap_agents(self):
+        """Re-points routed agents' paths at the merged node rows; agents whose path left the graph respawn on the next step."""
+        for slot in np.flatnonzero(self._routed[:self._next_slot]).tolist():
+            agent = self._slot_agents[slot]
+            rows = [self._nid_to_idx.get(node_id) for node_id in agent.path.tolist()]
+            edge_rows = None
+            if None not in rows:
+                rows = np.array(rows, dtype=np.intp)
+                edge_rows = _path_edge_rows(self._routing_csr.indptr, self._routing_csr.indices, rows)
+            if edge_rows is None or (edge_rows < 0).any():
+                self._routed[slot] = False
+                agent.path = agent.path_rows = None
             else:
-                agent.position += agent.velocity
-        
-        return {agent_id: agent.to_tensor() for agent_id, agent in self.agents.items()}
+                agent.path_rows = rows
+                agent.path_speeds = self._edge_speed_deg[edge_rows]
+                self._next_row[slot] = rows[agent.path_index + 1]
+                self._speed[slot] = agent.path_speeds[agent.path_index]
 
     def get_node_position(self, node_id):
-        return self.node_positions.get(int(node_id))
+        idx = self._nid_to_idx.get(int(node_id))
+        if idx is None:
+            return None
+        # Copy so agents moving from this position never write into the shared buffer
+        return self._node_xy[idx].copy()
 
     async def respawn_agent(self, agent: AgentState):
         """Respawns an agent with a new random start, goal, and path."""
-        nodes_in_viewport = self.get_nodes_in_bounds(self.bounds)
+        nodes_in_viewport = self._nodes_in_bounds_cached()
         
+        # Start and goal are both in the viewport, so the live search needn't go much further than its diagonal
+        search_limit = LIVE_SEARCH_RADIUS_FACTOR * ox.distance.great_circle(
+            self.bounds['minLat'], self.bounds['minLng'], self.bounds['maxLat'], self.bounds['maxLng']
+        )
         if len(nodes_in_viewport) < 2:
             nodes_in_viewport = self.valid_vehicle_node_ids
+            search_limit = np.inf
 
         if len(nodes_in_viewport) < 2:
             agent.path = None
             return
 
-        new_path = None
-        start_node_id, goal_node_id = None, None
+        new_rows = None
+        # One live Dijkstra from the first start that reaches anything serves every retry; only the goal changes
+        source_row, pred = None, None
 
-        for _ in range(20):  # Try up to 20 times to find a valid path
+        # Draw all 20 candidate (start, goal) pairs at once; pairs that drew the same node twice are skipped
+        pairs = self._rng.choice(nodes_in_viewport, size=(20, 2))
+        for start_node_id, goal_node_id in pairs[pairs[:, 0] != pairs[:, 1]].tolist():
             try:
-                start_node_id, goal_node_id = np.random.choice(nodes_in_viewport, 2, replace=False)
-                
-                path = await asyncio.to_thread(
-                    nx.shortest_path, self.drive_graph_proj, source=start_node_id, target=goal_node_id, weight='length'
-                )
-
-                if len(path) > 1:
-                    new_path = path
+                # Hub routes are a lookup; live Dijkstra only runs when there's no hub route
+                path_rows = self._route_via_hub(start_node_id)
+                if path_rows is None:
+                    if source_row is None:
+                        start_row = self._nid_to_idx[int(start_node_id)]
+                        routing_csr = self._routing_csr
+                        start_pred = await asyncio.to_thread(self._predecessors, start_row, search_limit)
+                        if self._slot_agents[agent.slot] is not agent:
+                            return  # removed while the search ran; its slot is no longer ours to write
+                        if self._routing_csr is not routing_csr:
+                            # The tiles were re-merged while the search ran, so its rows (and the
+                            # drawn nodes) belong to the old graph; start over on the new one
+                            return await self.respawn_agent(agent)
+                        if not (start_pred >= 0).any():
+                            continue  # a dead end; try another start
+                        source_row, pred = start_row, start_pred
+                    rows = _trace_predecessors(pred, self._nid_to_idx[int(goal_node_id)], source_row)
+                    path_rows = np.array(rows[::-1], dtype=np.intp) if rows is not None else None
+
+                if path_rows is not None and len(path_rows) > 1:
+                    new_rows = path_rows
                     break
-            except (nx.NetworkXNoPath, nx.NodeNotFound):
-                continue  # Try new nodes
+                # Otherwise there's no route between these two; try new nodes
             except Exception as e:
                 logger.warning(f"Error finding path for agent {agent.agent_id}, will retry: {e}")
                 continue
         
-        if new_path:
-            agent.path = new_path
+        if new_rows is not None:
+            # Rows come straight from the routing graph, so every node has a position
+            agent.path_rows = new_rows
+            agent.path = self._node_ids[new_rows]
             agent.path_index = 0
-            
-            start_pos = self.get_node_position(start_node_id)
-            goal_pos = self.get_node_position(goal_node_id)
-            
-            if start_pos is not None and goal_pos is not None:
-                agent.position = start_pos
-                agent.goal = goal_pos
-                path_nodes = [self.get_node_position(n) for n in new_path]
-                if all(p is not None for p in path_nodes):
-                    agent.path_positions = np.stack(path_nodes)
-                else:
-                    agent.path = None  # Path invalid because of missing node positions
-            else:
-                agent.path = None
+            agent.path_positions = self._node_xy[new_rows]
+            agent.path_speeds = self._edge_speed_deg[
+                _path_edge_rows(self._routing_csr.indptr, self._routing_csr.indices, new_rows)
+            ]
+            agent.position = agent.path_positions[0]
+            agent.goal = agent.path_positions[-1]
         else:
             agent.path = None
             logger.warning(f"Could not find a path for agent {agent.agent_id} after multiple attempts.")
 
+        self._routed[agent.slot] = agent.path is not None
+        if agent.path is not None:
+            self._set_next_target(agent)
+            self._start_edges([agent.slot])
+
     def get_agent_states(self):
+        # Every position comes out of the shared array in one gather and one tolist()
+        agents = self.agents.values()
+        slots = np.fromiter((agent.slot for agent in agents), dtype=np.intp, count=len(self.agents))
         return {
-            agent_id: {
-                "id": agent_id,
-                "position": agent.position.tolist(),
+            agent.agent_id: {
+                "id": agent.agent_id,
+                "position": position,
                 "path": agent.path_positions.tolist() if agent.path_positions is not None else []
-            } 
-            for agent_id, agent in self.agents.items()
+            }
+            for agent, position in zip(agents, self._pos[slots].tolist())
+        }
+
+    def get_agent_positions(self) -> Tuple[List[AgentState], np.ndarray]:
+        """Every agent alongside its [lat, lng] position row, gathered from the shared array in one go."""
+        agents = list(self.agents.values())
+        slots = np.fromiter((agent.slot for agent in agents), dtype=np.intp, count=len(agents))
+        return agents, self._pos[slots]
+
+    def get_agent_states_binary(self) -> Dict[str, Any]:
+        """Every active agent's position packed into one buffer, in slot order.
+
+        data holds little-endian int32 micro-degree [lat, lng] rows (shape [N, 2]),
+        the same scale the websocket updates use; ids[i] names the agent in row i.
+        """
+        slots = np.flatnonzero(self._active[:self._next_slot])
+        positions = np.round(self._pos[slots] * MICRODEGREES).astype('<i4')
+        return {
+            "ids": [self._slot_agents[slot].agent_id for slot in slots.tolist()],
+            "dtype": "<i4",
+            "shape": list(positions.shape),
+            "data": positions.tobytes(),
         }
 
     def get_emissions_data(self):
         """Generate emissions heatmap data points for all active agents"""
-        emissions_points = []
-        
-        for agent_id, agent in self.agents.items():
-            if agent.position is not None:
-                emissions_points.append({
-                    "position": [float(agent.position[1]), float(agent.position[0])],
-                    "weight": 1.0
-                })
-        
-        return emissions_points
+        # [lng, lat] for every active slot, converted in a single tolist()
+        positions = self._pos[:self._next_slot][self._active[:self._next_slot], ::-1].tolist()
+        return [{"position": position, "weight": 1.0} for position in positions]
 
     def get_traffic_light_states(self):
         """Returns the state and position of all traffic lights."""
-        print("--- get_traffic_light_states ---")
-        print(f"Total traffic light states to process: {len(self.traffic_light_states)}")
-        lights = []
-        for node_id, state in self.traffic_light_states.items():
-            position = self.get_node_position(node_id)
-            if position is not None:
-                light_data = {
-                    "id": int(node_id),
-                    "state": str(state),
-                    "position": [float(position[1]), float(position[0])]
-                }
-                print(f"  - Adding traffic light: {light_data}")
-                lights.append(light_data)
-            else:
-                print(f"  - Skipping traffic light {node_id} due to missing position.")
-        
-        print(f"Returning {len(lights)} traffic lights.")
-        print("---------------------------------")
+        # Lights are snapped to graph nodes, so every one has a position row; [lat, lng] -> [lng, lat]
+        positions = self._node_xy[self._tl_rows][:, ::-1].tolist()
+        lights = [
+            {
+                "id": node_id,
+                "state": 'red' if state == TL_RED else 'green',
+                "position": position
+            }
+            for node_id, state, position in zip(self._tl_node_ids.tolist(), self._tl_state.tolist(), positions)
+        ]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Returning {len(lights)} traffic lights.")
         return lights
@@ -0,0 +1,91 @@
+// Minimal MessagePack decoder for the simulation websocket.
+// Supports the subset emitted by msgspec: nil, booleans, ints, floats,
+// strings, binary, arrays and maps (no extension types).
+
+const textDecoder = new TextDecoder();
+
+export function decode(buffer) {
+    const bytes = buffer instanceof Uint8Array ? buffer : new Uint8Array(buffer);
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    let offset = 0;
+
+    const readStr = (length) => {
+        const str = textDecoder.decode(bytes.subarray(offset, offset + length));
+        offset += length;
+        return str;
+    };
+
+    const readBin = (length) => {
+        const bin = bytes.slice(offset, offset + length);
+        offset += length;
+        return bin;
+    };
+
+    const readArray = (length) => {
+        const arr = new Array(length);
+        for (let i = 0; i < length; i++) {
+            arr[i] = read();
+        }
+        return arr;
+    };
+
+    const readMap = (length) => {
+        const obj = {};
+        for (let i = 0; i < length; i++) {
+            const key = read();
+            obj[key] = read();
+        }
+        return obj;
+    };
+
+    const read = () => {
+        const type = bytes[offset++];
+
+        if (type <= 0x7f) return type;
+        if (type <= 0x8f) return readMap(type & 0x0f);
+        if (type <= 0x9f) return readArray(type & 0x0f);
+        if (type <= 0xbf) return readStr(type & 0x1f);
+        if (type >= 0xe0) return type - 0x100;
+
+        let value;
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: value = view.getUint8(offset); offset += 1; return readBin(value);
+            case 0xc5: value = view.getUint16(offset); offset += 2; return readBin(value);
+            case 0xc6: value = view.getUint32(offset); offset += 4; return readBin(value);
+            case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+            case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+            case 0xcc: value = view.getUint8(offset); offset += 1; return value;
+            case 0xcd: value = view.getUint16(offset); offset += 2; return value;
+            case 0xce: value = view.getUint32(offset); offset += 4; return value;
+            case 0xcf: value = Number(view.getBigUint64(offset)); offset += 8; return value;
+            case 0xd0: value = view.getInt8(offset); offset += 1; return value;
+            case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+            case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+            case 0xd3: value = Number(view.getBigInt64(offset)); offset += 8; return value;
+            case 0xd9: value = view.getUint8(offset); offset += 1; return readStr(value);
+            case 0xda: value = view.getUint16(offset); offset += 2; return readStr(value);
+            case 0xdb: value = view.getUint32(offset); offset += 4; return readStr(value);
+            case 0xdc: value = view.getUint16(offset); offset += 2; return readArray(value);
+            case 0xdd: value = view.getUint32(offset); offset += 4; return readArray(value);
+            case 0xde: value = view.getUint16(offset); offset += 2; return readMap(value);
+            case 0xdf: value = view.getUint32(offset); offset += 4; return readMap(value);
+            default:
+                throw new Error(`Unsupported MessagePack type 0x${type.toString(16)}`);
+        }
+    };
+
+    return read();
+}
+
+// Convert a raw IEEE 754 half-precision value (as a uint16) to a number
+export function float16ToNumber(h) {
+    const sign = h & 0x8000 ? -1 : 1;
+    const exponent = (h >> 10) & 0x1f;
+    const fraction = h & 0x3ff;
+    if (exponent === 0) return sign * Math.pow(2, -14) * (fraction / 1024);
+    if (exponent === 0x1f) return fraction ? NaN : sign * Infinity;
+    return sign * Math.pow(2, exponent - 15) * (1 + fraction / 1024);
+}
@@ -9,11 +9,31 @@ import ControlPanel from '../components/ControlPanel.jsx';
 import InfoPanel from '../components/InfoPanel.jsx';
 import DebugConsole from '../components/DebugConsole.jsx';
 import config from '../config.js';
+import { decode as decodeMessage, float16ToNumber } from '../utils/msgpack.js';
 import 'mapbox-gl/dist/mapbox-gl.css';
 
 const WS_URL = `${config.WS_BASE_URL}/ws/traffic`;
 const MAPBOX_TOKEN = import.meta.env.VITE_MAPBOX_TOKEN;
 
+// Coordinates arrive as int micro-degrees
+const COORD_SCALE = 1e6;
+
+const dequantize = ([a, b]) => [a / COORD_SCALE, b / COORD_SCALE];
+
+// Emissions arrive as packed int32 [lng, lat] pairs and float16 weights
+const unpackEmissions = ({ positions, weights }) => {
+    const xy = new Int32Array(positions.buffer, positions.byteOffset, positions.byteLength / 4);
+    const w = new Uint16Array(weights.buffer, weights.byteOffset, weights.byteLength / 2);
+    const points = new Array(w.length);
+    for (let i = 0; i < w.length; i++) {
+        points[i] = {
+            position: [xy[2 * i] / COORD_SCALE, xy[2 * i + 1] / COORD_SCALE],
+            weight: float16ToNumber(w[i])
+        };
+    }
+    return points;
+};
+
 const INITIAL_VIEW_STATE = {
     longitude: -122.399255,
     latitude: 37.792633,
@@ -45,12 +65,14 @@ export default function SFMap() {
     const [muniStops, setMuniStops] = useState(null);
     const [sfParcels, setSfParcels] = useState(null);
     const wsRef = useRef(null);
+    const agentCacheRef = useRef(new Map());
     const viewStateRef = useRef(INITIAL_VIEW_STATE);
 
     const isInitialLoadRef = useRef(true);
 
     const connect = useCallback(() => {
         const ws = new WebSocket(WS_URL);
+        ws.binaryType = 'arraybuffer';
         wsRef.current = ws;
 
         ws.onopen = () => {
@@ -60,10 +82,11 @@ export default function SFMap() {
 
         ws.onmessage = (ev) => {
             try {
-                const parsed = JSON.parse(ev.data);
+                // The server sends MessagePack-encoded binary frames
+                const parsed = decodeMessage(ev.data);
 
                 setLogs(prev => {
-                    const message = parsed.message || `Received data: ${ev.data.substring(0, 100)}...`;
+                    const message = parsed.message || `Received ${parsed.type} (${ev.data.byteLength} bytes)`;
                     const newLog = { type: parsed.type, message: message };
                     return [newLog, ...prev].slice(0, 50);
                 });
@@ -75,10 +98,27 @@ export default function SFMap() {
                 }
 
                 if (parsed.type === 'update') {
-                    const agentArray = Object.values(parsed.agents);
-                    setAgents(agentArray);
+                    // Updates are deltas against the agents we already have
+                    const agentCache = agentCacheRef.current;
+                    if (parsed.full) {
+                        agentCache.clear();
+                    }
+                    for (const [id, delta] of Object.entries(parsed.agents)) {
+                        const agent = { ...agentCache.get(id), id };
+                        if (delta.position) {
+                            agent.position = dequantize(delta.position);
+                        }
+                        if (delta.path) {
+                            agent.path = delta.path.map(dequantize);
+                        }
+                        agentCache.set(id, agent);
+                    }
+                    for (const id of parsed.removed || []) {
+                        agentCache.delete(id);
+                    }
+                    setAgents(Array.from(agentCache.values()));
                     if (parsed.emissions) {
-                        setEmissions(parsed.emissions);
+                        setEmissions(unpackEmissions(parsed.emissions));
                     }
                     if (showTrafficLights && parsed.traffic_lights) {
                         // Cache positions and update traffic lights with stable positions
@@ -126,7 +166,10 @@ export default function SFMap() {
                     }
                 } else if (parsed.type === 'sf_parcels') {
                     if (showSfParcels && parsed.data) {
-                        setSfParcels(parsed.data);
+                        // Large results arrive in chunks; later chunks extend the first
+                        setSfParcels(prev => parsed.append && prev
+                            ? { ...prev, features: prev.features.concat(parsed.data.features) }
+                            : parsed.data);
                     } else {
                         setSfParcels(null);
                     }
@@ -185,6 +228,18 @@ export default function SFMap() {
         }
     }, [showSfParcels]);
 
+    // Tell the server about BART/Muni toggles right away: it only re-sends a layer it
+    // knows we dropped, so it mustn't wait for the next pan to hear about it
+    useEffect(() => {
+        if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
+            wsRef.current.send(JSON.stringify({
+                type: 'set_layers',
+                show_bart_lines: showBartLines,
+                show_muni_stops: showMuniStops
+            }));
+        }
+    }, [showBartLines, showMuniStops]);
+
     // Animation loop for trails
     useEffect(() => {
         if (!showTrails) return;